@@ -0,0 +1,183 @@
+"""
+Local stand-in for the RnDflow executor API and the presigned-URL object storage.
+
+Only the endpoints used by rndflow.execute.Job and rndflow.server.Server are
+implemented. Every request is delayed by `latency` seconds and bodies are
+throttled to `bandwidth` bytes per second, so transfer-bound code paths can be
+measured on one machine.
+"""
+import base64
+import hashlib
+import json
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+#---------------------------------------------------------------------------
+def fake_jwt(lifetime=3600):
+    def encode(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b'=').decode()
+    return '.'.join((encode(dict(alg='none')), encode(dict(exp=time.time() + lifetime)), 'signature'))
+
+#---------------------------------------------------------------------------
+class FakeState:
+    def __init__(self, latency=0.0, bandwidth=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = Lock()
+        self.objects = {}   # content hash -> bytes
+        self.jobs = {}      # job id -> dict(job, files, packages)
+        self.requests = {}  # endpoint -> count
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def add_object(self, data):
+        h = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            self.objects[h] = data
+        return h
+
+    def add_job(self, job_id, files=None, packages=None, script='true', fields=None):
+        """
+        files: {name: bytes}, packages: [dict(id, label, fields)]
+        """
+        job_files = []
+        for name, data in (files or {}).items():
+            h = self.add_object(data)
+            job_files.append(dict(name=name, content=f'/objects/{h}', content_hash=h,
+                size=len(data), is_executable=False, is_binary=True, type='application/x-binary'))
+
+        self.jobs[job_id] = dict(
+            job = dict(id=job_id, is_interactive=False, node=dict(script=script),
+                fields=[dict(name=k, value=v) for k, v in (fields or {}).items()]),
+            files = job_files,
+            packages = [dict(id=p['id'], label=p.get('label', ''),
+                fields=[dict(name=k, value=v) for k, v in p.get('fields', {}).items()])
+                for p in (packages or [])],
+            )
+
+#---------------------------------------------------------------------------
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None
+    base = None
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+    def count(self, endpoint):
+        with self.state.lock:
+            self.state.requests[endpoint] = self.state.requests.get(endpoint, 0) + 1
+
+    def throttle(self, nbytes):
+        if self.state.bandwidth:
+            time.sleep(nbytes / self.state.bandwidth)
+
+    def read_body(self):
+        size = int(self.headers.get('Content-Length', 0))
+        data = bytearray() # Appending to bytes would copy the whole body for every chunk
+        while len(data) < size:
+            chunk = self.rfile.read(min(65536, size - len(data)))
+            if not chunk:
+                break
+            self.throttle(len(chunk))
+            data += chunk
+        with self.state.lock:
+            self.state.bytes_in += len(data)
+        return bytes(data)
+
+    def send_body(self, data, status=200, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        for i in range(0, len(data), 65536):
+            chunk = data[i:i + 65536]
+            self.throttle(len(chunk))
+            self.wfile.write(chunk)
+        with self.state.lock:
+            self.state.bytes_out += len(data)
+
+    def send_json(self, data, status=200):
+        self.send_body(json.dumps(data).encode(), status)
+
+    def route(self):
+        time.sleep(self.state.latency)
+
+        path = self.path.split('?')[0]
+        endpoint = re.sub(r'/\d+(?=/|$)', '/{id}', re.sub(r'/[0-9a-f]{64}(?=/|$)', '/{hash}', path))
+        self.count(f'{self.command} {endpoint}')
+
+        body = self.read_body() if self.command in ('POST', 'PUT') else b''
+
+        m = re.fullmatch(r'/objects/([0-9a-f]{64})', path)
+        if m:
+            if self.command == 'PUT':
+                with self.state.lock:
+                    self.state.objects[m.group(1)] = body
+                return self.send_body(b'', content_type='text/plain')
+            data = self.state.objects.get(m.group(1))
+            if data is None:
+                return self.send_body(b'not found', 404, 'text/plain')
+            return self.send_body(data, content_type='application/octet-stream')
+
+        if path == '/api/executor_api/auth/refresh':
+            return self.send_json(dict(access_token=fake_jwt(), refresh_token=fake_jwt(86400)))
+
+        m = re.fullmatch(r'/api/executor_api/jobs/(\d+)(/.*)?', path)
+        if not m:
+            return self.send_json(dict(detail='not found'), 404)
+
+        job = self.state.jobs.get(int(m.group(1)))
+        action = m.group(2) or ''
+        if job is None:
+            return self.send_json(dict(detail='job not found'), 404)
+
+        if self.command == 'GET' and action == '':
+            return self.send_json(job['job'])
+        if self.command == 'GET' and action == '/files':
+            return self.send_json([dict(f, content=self.base + f['content']) for f in job['files']])
+        if self.command == 'GET' and action == '/packages':
+            return self.send_json(job['packages'])
+        if self.command == 'POST' and action in ('/heartbeat', '/status', '/error'):
+            return self.send_json({})
+        if self.command == 'POST' and action == '/upload_objects':
+            request = json.loads(body)
+            check = request.get('check_exists', True)
+            return self.send_json([dict(object_id=h,
+                link=None if check and h in self.state.objects else f'{self.base}/objects/{h}')
+                for h in request['objects']])
+        if self.command == 'PUT' and action == '':
+            job['result'] = json.loads(body)
+            return self.send_json({})
+
+        return self.send_json(dict(detail='not found'), 404)
+
+    do_GET = do_POST = do_PUT = do_HEAD = route
+
+#---------------------------------------------------------------------------
+class FakeServer:
+    """
+    with FakeServer(latency=0.01, bandwidth=50e6) as fake:
+        fake.state.add_job(1, files={'in/1/files/a.bin': b'...'})
+        ... connect rndflow to fake.url ...
+    """
+    def __init__(self, latency=0.0, bandwidth=None, host='127.0.0.1', port=0):
+        self.state = FakeState(latency, bandwidth)
+        handler = type('Handler', (FakeHandler,), dict(state=self.state))
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.url = f'http://{host}:{self.httpd.server_address[1]}'
+        handler.base = self.url
+        self.thread = Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.httpd.shutdown()
+        self.httpd.server_close()
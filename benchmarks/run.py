@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the RnDflow job helper against a local fake API and object storage.
+
+    python benchmarks/run.py [--latency 0.005] [--bandwidth 100e6] [--scale 1] [--repeat 3]
+                             [--only download_small upload_large ...]
+                             [--output benchmarks/results] [--compare results/previous.json]
+
+Results are written to <output>/<date>-<commit>.json. With --compare the
+times are printed next to a previous result file.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCH_DIR.parent
+sys.path.insert(0, str(REPO_DIR)) # Measure the working tree, not an installed package
+
+# Settings are parsed once, on the first rndflow import
+os.environ.setdefault('RNDFLOW_REFRESH_TOKEN', 'benchmark')
+os.environ.setdefault('RNDFLOW_HEARTBEAT_INTERVAL', '3600')
+os.environ.setdefault('RNDFLOW_RESOURCE_SAMPLE_INTERVAL', '0')
+os.environ.setdefault('RNDFLOW_LOGGING_LEVEL', 'WARNING')
+
+from fake_server import FakeServer # pylint: disable=wrong-import-position
+
+BENCHMARKS = {}
+MiB = 1024 * 1024 # pylint: disable=invalid-name
+
+#---------------------------------------------------------------------------
+def benchmark(fn):
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+#---------------------------------------------------------------------------
+def measure(fn, repeat, setup=None):
+    """
+    Run fn(setup()) `repeat` times; only fn is timed.
+    """
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        fn(arg)
+        times.append(time.perf_counter() - start)
+    return dict(best=min(times), median=statistics.median(times), runs=len(times))
+
+#---------------------------------------------------------------------------
+class Context:
+    def __init__(self, args, fake, workdir):
+        self.args = args
+        self.fake = fake
+        self.workdir = workdir
+        self.next_job = 1
+
+    def scaled(self, n):
+        return max(1, int(n * self.args.scale))
+
+    def job_id(self):
+        self.next_job += 1
+        return self.next_job
+
+    def new_job(self, job_id):
+        from rndflow.execute import Job # pylint: disable=import-outside-toplevel
+        job = Job(self.fake.url, job_id)
+        job.status = 0
+        return job
+
+#---------------------------------------------------------------------------
+def download(ctx, count, size):
+    def setup():
+        job_id = ctx.job_id()
+        ctx.fake.state.add_job(job_id,
+            files={f'in/1/files/{i}.bin': os.urandom(size) for i in range(count)},
+            packages=[dict(id=1, label='input')])
+        return ctx.new_job(job_id)
+
+    def run(job):
+        try:
+            job.download()
+        finally:
+            job.stop()
+
+    result = measure(run, ctx.args.repeat, setup)
+    result['bytes_per_second'] = count * size / result['best']
+    return result
+
+@benchmark
+def download_small(ctx):
+    return download(ctx, ctx.scaled(200), 16 * 1024)
+
+@benchmark
+def download_large(ctx):
+    return download(ctx, ctx.scaled(4), 32 * MiB)
+
+#---------------------------------------------------------------------------
+def upload(ctx, count, size):
+    def setup():
+        job_id = ctx.job_id()
+        ctx.fake.state.add_job(job_id)
+        job = ctx.new_job(job_id)
+        out = job.root / 'out' / '1' / 'files'
+        out.mkdir(parents=True)
+        for i in range(count):
+            (out / f'{i}.bin').write_bytes(os.urandom(size))
+        return job
+
+    def run(job):
+        try:
+            job.upload()
+        finally:
+            job.stop()
+
+    result = measure(run, ctx.args.repeat, setup)
+    result['bytes_per_second'] = count * size / result['best']
+    return result
+
+@benchmark
+def upload_small(ctx):
+    return upload(ctx, ctx.scaled(200), 16 * 1024)
+
+@benchmark
+def upload_large(ctx):
+    return upload(ctx, ctx.scaled(4), 32 * MiB)
+
+#---------------------------------------------------------------------------
+@benchmark
+def file_hash(ctx):
+    from rndflow.server import file_hash as hash_file # pylint: disable=import-outside-toplevel
+
+    path = ctx.workdir / 'hash.bin'
+    size = ctx.scaled(256) * MiB
+    with open(path, 'wb') as f:
+        for _ in range(size // MiB):
+            f.write(os.urandom(MiB))
+
+    result = measure(lambda _: hash_file(path), ctx.args.repeat)
+    result['bytes_per_second'] = size / result['best']
+    path.unlink()
+    return result
+
+#---------------------------------------------------------------------------
+@benchmark
+def hdf5(ctx):
+    import numpy # pylint: disable=import-outside-toplevel
+    from rndflow.job import save_hdf5 # pylint: disable=import-outside-toplevel
+    from rndflow.file_readers import load_hdf5 # pylint: disable=import-outside-toplevel
+
+    data = numpy.random.default_rng(0).random((ctx.scaled(2000), 2000))
+    path = ctx.workdir / 'data.h5'
+
+    return dict(
+        bytes = data.nbytes,
+        save  = measure(lambda _: save_hdf5(path, data), ctx.args.repeat),
+        load  = measure(lambda _: load_hdf5(path), ctx.args.repeat),
+        )
+
+@benchmark
+def csv(ctx):
+    import numpy # pylint: disable=import-outside-toplevel
+    import pandas # pylint: disable=import-outside-toplevel
+    from rndflow.file_readers import load_csv # pylint: disable=import-outside-toplevel
+
+    frame = pandas.DataFrame(numpy.random.default_rng(0).random((ctx.scaled(200000), 10)))
+    path = ctx.workdir / 'data.csv'
+
+    return dict(
+        rows = len(frame),
+        save = measure(lambda _: frame.to_csv(path, index=False), ctx.args.repeat),
+        load = measure(lambda _: load_csv(path), ctx.args.repeat),
+        )
+
+@benchmark
+def save_package(ctx):
+    import numpy # pylint: disable=import-outside-toplevel
+    from rndflow import job # pylint: disable=import-outside-toplevel
+
+    rng = numpy.random.default_rng(0)
+    fields = {f'field{i}': float(v) for i, v in enumerate(rng.random(1000))}
+    files = {f'array{i}': rng.random(10000) for i in range(ctx.scaled(20))}
+
+    return measure(lambda _: job.save_package(label='bench', fields=fields, files=files), ctx.args.repeat)
+
+#---------------------------------------------------------------------------
+@benchmark
+def heartbeat(ctx):
+    job_id = ctx.job_id()
+    ctx.fake.state.add_job(job_id)
+    job = ctx.new_job(job_id)
+
+    line = '[01/01/2024 00:00:00 UTC] ' + 'x' * 100 + '\n'
+    size = ctx.scaled(100) * MiB
+    with open(job.log_file, 'a', encoding='utf-8') as f:
+        f.write(line * (size // len(line)))
+
+    try:
+        changed = measure(lambda _: job.heartbeat_send(),
+            ctx.args.repeat, setup=job.log_file.touch)
+        unchanged = measure(lambda _: job.heartbeat_send(), ctx.args.repeat)
+    finally:
+        job.stop()
+
+    return dict(log_bytes=size, changed=changed, unchanged=unchanged)
+
+#---------------------------------------------------------------------------
+@benchmark
+def import_time(ctx):
+    code = 'import time; t = time.perf_counter(); import rndflow.job; print(time.perf_counter() - t)'
+    env = dict(os.environ, PYTHONPATH=str(REPO_DIR))
+
+    def run(_):
+        subprocess.run([sys.executable, '-c', code], cwd=ctx.workdir, env=env, check=True,
+                stdout=subprocess.DEVNULL)
+
+    return measure(run, ctx.args.repeat)
+
+#---------------------------------------------------------------------------
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return 'unknown'
+
+#---------------------------------------------------------------------------
+def flatten(results, prefix=''):
+    for name, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f'{prefix}{name}.')
+        else:
+            yield f'{prefix}{name}', value
+
+#---------------------------------------------------------------------------
+def compare(current, previous):
+    old = dict(flatten(previous['results']))
+    print(f'\n{"metric":<40} {"previous":>12} {"current":>12} {"ratio":>8}')
+    for name, value in flatten(current['results']):
+        if not (name.endswith('.best') or name.endswith('bytes_per_second')) or name not in old:
+            continue
+        ratio = value / old[name] if old[name] else float('nan')
+        print(f'{name:<40} {old[name]:>12.4g} {value:>12.4g} {ratio:>8.2f}')
+
+#---------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds added to every request')
+    parser.add_argument('--bandwidth', type=float, default=None, help='bytes per second, unlimited by default')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply data sizes and counts')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='*', choices=sorted(BENCHMARKS))
+    parser.add_argument('--output', type=Path, default=BENCH_DIR / 'results')
+    parser.add_argument('--compare', type=Path)
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp, FakeServer(args.latency, args.bandwidth) as fake:
+        # rndflow.job takes the job id from the name of the working directory
+        workdir = Path(tmp) / '1'
+        workdir.mkdir()
+        os.chdir(workdir)
+
+        ctx = Context(args, fake, workdir)
+        for name in args.only or BENCHMARKS:
+            print(f'{name}...', flush=True)
+            results[name] = BENCHMARKS[name](ctx)
+            print(json.dumps(results[name]), flush=True)
+
+        requests = dict(fake.state.requests)
+
+    commit = git_commit()
+    report = dict(
+        meta = dict(
+            date      = datetime.now().isoformat(timespec='seconds'),
+            commit    = commit,
+            python    = platform.python_version(),
+            platform  = platform.platform(),
+            latency   = args.latency,
+            bandwidth = args.bandwidth,
+            scale     = args.scale,
+            repeat    = args.repeat,
+            ),
+        results = results,
+        requests = requests,
+        )
+
+    args.output.mkdir(parents=True, exist_ok=True)
+    path = args.output / f'{datetime.now():%Y%m%d-%H%M%S}-{commit}.json'
+    path.write_text(json.dumps(report, indent=2))
+    print(f'Results written to {path}')
+
+    if args.compare:
+        compare(report, json.loads(args.compare.read_text()))
+
+if __name__ == '__main__':
+    main()
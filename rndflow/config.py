@@ -1,4 +1,8 @@
-from typing import Optional, Union
+import json
+import os
+from pathlib import Path
+from threading import Lock
+from typing import List, Optional, Union
 from pydantic import Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -7,7 +11,42 @@ class Settings(BaseSettings):
     api_server_direct: Optional[str] = None  # Connect to API server
     refresh_token: str
 
+    token_refresh_margin: int = 60           # Refresh access token this many seconds (at most half its lifetime) before it expires
+
     heartbeat_interval: int = 60
+    heartbeat_log_lines: int = 100
+    heartbeat_log_diff: bool = False         # Send only the log appended since the last acknowledged heartbeat
+    heartbeat_log_max_bytes: int = 1048576   # Upper limit of log text in one heartbeat
+
+    # Output upload filters, .gitignore-like globs (see rndflow.scanner.ScanRules).
+    # The job may also put exclude rules into upload_ignore_file in its working directory.
+    upload_exclude: List[str] = []
+    upload_include: List[str] = []           # Re-include files excluded by the rules above
+    upload_ignore_file: str = '.rndflowignore'
+    upload_max_files: Optional[int] = None   # Fail the upload early when the job produced more files...
+    upload_max_bytes: Optional[int] = None   # ...or more data than this
+
+    stream_outputs: bool = False             # Upload finished files from out/ while the job is still running
+    stream_poll_interval: float = 10
+    stream_stable_seconds: float = 30        # File is considered finished when unchanged for this long and closed
+
+    trace_file: Optional[str] = None         # Append a JSON line per HTTP request (endpoint, timings, retries, sizes)
+
+    metrics_prometheus_file: Optional[str] = None  # Also write job metrics for the node_exporter textfile collector
+
+    load_cache_bytes: int = 0                # Memory for decoded inputs shared by job.load() calls. 0 disables
+
+    lazy_inputs: bool = False                # Start the script before in/ files are downloaded, fetch them on demand
+
+    object_cache_dir: Optional[str] = None   # Downloaded objects kept by content hash for later jobs (worker mode)
+    object_cache_max_bytes: int = 10 * 1024**3
+
+    download_workers: int = 4                # Parallel input downloads, largest files first
+    download_check_space: bool = True        # Fail before downloading if the inputs do not fit on disk
+    download_space_reserve: int = 64 * 1024**2  # Bytes that must stay free after all inputs are downloaded
+
+    resource_sample_interval: float = 5      # Seconds between /proc samples of the job processes. 0 disables
+    resource_series_max_points: int = 2048
 
     ssl_verify: bool = True
 
@@ -36,12 +75,112 @@ class Settings(BaseSettings):
     spec_conn_timeout: Union[int, float] = 300
     spec_conn_read_timeout: Union[int, float] = 300000
 
+    # Heartbeats use their own short-timeout connection and never wait long for a slow server
+    heartbeat_conn_retry_total: int = 1
+    heartbeat_conn_retry_read: int = 0
+    heartbeat_conn_retry_connect: int = 1
+    heartbeat_conn_retry_redirect: int = 1
+    heartbeat_conn_retry_status: int = 0
+    heartbeat_conn_retry_other: int = 0
+    heartbeat_conn_retry_backoff_factor: float = 0.1
+
+    heartbeat_conn_timeout: Union[int, float] = 10
+    heartbeat_conn_read_timeout: Union[int, float] = 30
+
+    # https://urllib3.readthedocs.io/en/stable/advanced-usage.html#customizing-pool-behavior
+    # pool_connections: number of per-host pools to keep, pool_maxsize: connections kept per host,
+    # pool_block: wait for a free connection instead of opening (and later discarding) an extra one.
+    common_conn_pool_connections: int = 10
+    common_conn_pool_maxsize: int = 10
+    common_conn_pool_block: bool = False
+
+    spec_conn_pool_connections: int = 10
+    spec_conn_pool_maxsize: int = 10
+    spec_conn_pool_block: bool = False
+
+    heartbeat_conn_pool_connections: int = 1
+    heartbeat_conn_pool_maxsize: int = 1
+    heartbeat_conn_pool_block: bool = False
+
+    raw_conn_pool_connections: int = 10     # Object storage (presigned links) session
+    raw_conn_pool_maxsize: int = 32
+    raw_conn_pool_block: bool = True
+
+    conn_keep_alive: bool = True            # HTTP keep-alive. False sends 'Connection: close'
+    conn_tcp_keepalive: bool = True         # TCP keep-alive probes on idle pooled sockets
+    conn_tcp_keepalive_idle: int = 60
+    conn_tcp_keepalive_interval: int = 20
+    conn_tcp_keepalive_count: int = 5
+
     logging_level: str = 'INFO'
 
     tz: str = Field('Europe/Moscow', alias='TZ')  # TZ env set by executor . Ignore common setting prefix by alias
 
     dateformat: str = '%d/%m/%Y %H:%M:%S %Z'
 
-    model_config = SettingsConfigDict(env_prefix='rndflow_')
+    model_config = SettingsConfigDict(env_prefix='rndflow_', frozen=True)
 
 #print(str(Settings()).replace(' ', '\n'))
+
+#---------------------------------------------------------------------------
+_settings = None        # pylint: disable=invalid-name #(cached by settings())
+_settings_lock = Lock()
+
+#---------------------------------------------------------------------------
+def load_settings(path=None) -> Settings:
+    """
+    Build a new Settings object.
+
+    Values come from the environment and optionally from a file, whose path
+    defaults to the RNDFLOW_SETTINGS_FILE environment variable. Values in a
+    JSON file (see save_settings) override the environment; a dotenv file only
+    supplies variables that are not set in the environment.
+    """
+    path = path or os.environ.get('RNDFLOW_SETTINGS_FILE')
+    if path is None:
+        return Settings()
+
+    path = Path(path)
+    if path.suffix.lower() == '.json':
+        return Settings(**json.loads(path.read_text(encoding='utf-8')))
+
+    return Settings(_env_file=path)
+
+#---------------------------------------------------------------------------
+def settings() -> Settings:
+    """
+    Shared immutable configuration snapshot. Parsed once, on first use.
+    """
+    global _settings # pylint: disable=global-statement
+
+    if _settings is None:
+        with _settings_lock:
+            if _settings is None:
+                _settings = load_settings()
+
+    return _settings
+
+#---------------------------------------------------------------------------
+def reload_settings(path=None) -> Settings:
+    """
+    Re-read the configuration and replace the shared snapshot.
+
+    Objects created before the reload keep the snapshot they were built with.
+    """
+    global _settings # pylint: disable=global-statement
+
+    cfg = load_settings(path)
+    with _settings_lock:
+        _settings = cfg
+
+    return cfg
+
+#---------------------------------------------------------------------------
+def save_settings(path, cfg: Settings=None):
+    """
+    Write the configuration snapshot to a JSON file for reproducibility.
+    The refresh token is a secret and is never written.
+    """
+    cfg = cfg or settings()
+    data = cfg.model_dump(mode='json', by_alias=True, exclude={'refresh_token'})
+    Path(path).write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding='utf-8')
@@ -0,0 +1,8 @@
+#---------------------------------------------------------------------------
+class JobLimitError(Exception):
+    """
+    The job went over a configured limit (output size, disk space...).
+    """
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
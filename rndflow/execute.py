@@ -1,22 +1,34 @@
-import json
+import hashlib
 import mimetypes
 import os
+import shutil
 import subprocess
+import sys
+import tempfile
 import time
 import traceback
 
-from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from textwrap import dedent
-from threading import Event, Thread, Timer
+from threading import Event, Lock, Thread, Timer
 
 import argparse
 from binaryornot.check import is_binary
 
-from .server import Server, file_hash, PossibleNetworkError
-from .config import Settings
+from .server import Server, file_hash, response_retries, PossibleNetworkError
+from .errors import JobLimitError
+from .config import settings
+from .metrics import JobMetrics
+from .prefetch import INDEX_FILE, InputPrefetcher
+from .resources import ResourceSampler
+from .serializer import write_json
+from .scanner import DEFAULT_EXCLUDE, ScanRules, scan_files
+from .streaming import OutputStreamer
 
-from .logger import make_file_stdout_logger
+from .logger import logger, make_file_stdout_logger, close_file_logger
+
+STREAM_DIR = '.rndflow-stream'  # Snapshots of output files being streamed (see Job.stream_upload)
 
 #---------------------------------------------------------------------------------------
 def timer_or_event(duration , event):
@@ -26,43 +38,113 @@ def timer_or_event(duration , event):
     timer.cancel()  # Stop the timer if job finished
     event.clear()
 
+#---------------------------------------------------------------------------------------
+def get_binary_and_type(path):
+    binary = is_binary(str(path))
+
+    file_type, _ = mimetypes.guess_type(str(path))
+    if file_type is None:
+        file_type = 'application/x-binary' if binary else 'text/plain'
+
+    return binary, file_type
+
 #---------------------------------------------------------------------------------------
 class Job:
 
-    def __init__(self, host: str, job_id: int):
+    def __init__(self, host: str, job_id: int, server: Server = None):
         self.job = None
         self.status = None
         self.job_id = job_id
-        self.server = Server(host)
-        self.cfg = Settings()
+        self.cfg = settings()
+        self.server = server or Server(host, cfg=self.cfg) # A worker passes its server to reuse connections and tokens
 
         self.root = Path(str(job_id)).resolve()
         self.root.mkdir(parents=True, exist_ok=True)
 
         self.log_file = self.root / f'{self.job_id}.log'
+        self.artefacts = self.root / '.rndflow'  # Job statistics, uploaded with the job output
         self.logger = make_file_stdout_logger(self.log_file)
 
         self.data_upload = False
 
+        self.prefetcher = None
+
+        self.hashes = {}        # path -> ((size, mtime), content hash)
+        self.uploaded = set()   # Content hashes already uploaded or present on the server
+
+        self.metrics = JobMetrics(job_id)
+        self.resources = ResourceSampler(self.cfg.resource_sample_interval, self.cfg.resource_series_max_points)
+
+        self.log_state = None   # (size, mtime) of the log file at the last acknowledged heartbeat
+        self.log_offset = 0     # Log bytes acknowledged by the server (heartbeat_log_diff mode)
+        self.log_tail_text = ''
+
         self.done = Event()
+        self.heartbeat_lock = Lock()
         self.heartbeat_sleep = Event()
         self.heartbeat_thread = Thread(target=self.heartbeat)
         self.heartbeat_thread.start()
 
     def log_tail(self):
-        if self.log_file.is_file:
-            with open(self.log_file, encoding="utf-8") as log_file:
-                tail = ''.join(deque(log_file, 100))
-        else:
-            tail = ''
+        lines = self.cfg.heartbeat_log_lines
+        chunk = 65536
+        data = b''
+        try:
+            with open(self.log_file, 'rb') as log_file:
+                pos = log_file.seek(0, os.SEEK_END)
+                while pos > 0 and data.count(b'\n') <= lines and len(data) < self.cfg.heartbeat_log_max_bytes:
+                    step = min(chunk, pos)
+                    pos -= step
+                    log_file.seek(pos)
+                    data = log_file.read(step) + data
+        except FileNotFoundError:
+            pass
+
+        return b''.join(data.splitlines(keepends=True)[-lines:]).decode('utf-8', errors='replace')
+
+    def log_append(self, size):
+        offset = self.log_offset if self.log_offset <= size else 0 # Log file was truncated
+        offset = max(offset, size - self.cfg.heartbeat_log_max_bytes)
+        with open(self.log_file, 'rb') as log_file:
+            log_file.seek(offset)
+            data = log_file.read(size - offset)
+        return offset, data.decode('utf-8', errors='replace')
+
+    def heartbeat_payload(self):
+        try:
+            stat = self.log_file.stat()
+            state = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            state = (0, None)
+
+        if state != self.log_state:
+            self.log_tail_text = self.log_tail()
 
-        return tail
+        if not self.cfg.heartbeat_log_diff:
+            return state, dict(log_tail=self.log_tail_text)
+
+        if state == self.log_state:
+            return state, dict(log_tail_hash=hashlib.sha256(self.log_tail_text.encode('utf-8')).hexdigest())
+
+        offset, text = self.log_append(state[0])
+        return state, dict(log_offset=offset, log_append=text)
 
     def heartbeat_send(self):
-        try:
-            self.server.post(f'/executor_api/jobs/{self.job_id}/heartbeat', json=dict(log_tail=self.log_tail()))
-        except Exception as e:
-            self.logger.error('Heartbeat exception: %s', e)
+        with self.heartbeat_lock: # The heartbeat thread and upload() may send at the same time
+            try:
+                state, payload = self.heartbeat_payload()
+                resources = self.resources.summary()
+                if resources is not None:
+                    payload['resources'] = resources
+                self.server.heartbeat_post(f'/executor_api/jobs/{self.job_id}/heartbeat', json=payload)
+                self.log_state = state
+                self.log_offset = state[0]
+            except Exception as e:
+                self.logger.error('Heartbeat exception: %s', e)
+
+    def heartbeat_now(self):
+        # Wake the heartbeat thread instead of sending from the caller: a slow server must not delay the job
+        self.heartbeat_sleep.set()
 
     def heartbeat(self):
         while not self.done.is_set():
@@ -72,43 +154,127 @@ class Job:
     def download(self):
 
         self.job = self.server.get(f'/executor_api/jobs/{self.job_id}')
-        self.heartbeat_send()
+        self.heartbeat_now()
         job_files = self.server.get(f'/executor_api/jobs/{self.job_id}/files')
         job_packages = self.server.get(f'/executor_api/jobs/{self.job_id}/packages')
 
+        params = {m['name'] : m['value'] for m in self.job['fields']}
+
         (self.root / 'in').mkdir(parents=True, exist_ok=True)
-        (self.root / 'in' / 'params.json').write_text(
-                json.dumps(
-                    {m['name'] : m['value'] for m in self.job['fields']},
-                    ensure_ascii=False))
+        write_json(self.root / 'in' / 'params.json', params)
 
         files = {self.root / f['name']: (self.root, f)
                 for f in job_files if Path(f['name']).parts[0] != 'out'}
 
+        # Node files outside of in/ (scripts etc) are always downloaded before the start
+        lazy = {}
+        if self.cfg.lazy_inputs:
+            lazy = {k: v for k, v in files.items() if Path(v[1]['name']).parts[0] == 'in'}
+            files = {k: v for k, v in files.items() if k not in lazy}
+
+        input_files = [dict(name=f['name'], size=f.get('size'), content_hash=f['content_hash'])
+                for _, f in (*files.values(), *lazy.values()) if Path(f['name']).parts[0] == 'in']
+
+        package_files = {}
+        for f in input_files:
+            parts = Path(f['name']).parts
+            if len(parts) == 4 and parts[2] == 'files':
+                package_files.setdefault(parts[1], []).append(dict(f, name=parts[3]))
+
+        self.check_free_space([f for _, f in (*files.values(), *lazy.values())])
+
+        index_packages = []
         for package in job_packages:
             path = self.root / 'in' / str(package['id'])
             path.mkdir(parents=True, exist_ok=True)
 
-            (path / 'label').write_text(package['label'])
-
-            (path / 'fields.json').write_text(
-                    json.dumps(
-                        {m['name'] : m['value'] for m in package['fields']},
-                        ensure_ascii=False))
+            fields = {m['name'] : m['value'] for m in package['fields']}
 
-        for p, f in files.values():
-            self.server.download(f, folder=p)
+            (path / 'label').write_text(package['label'])
 
-        self.logger.info('Job inputs data downloaded.')
+            write_json(path / 'fields.json', fields)
+
+            index_packages.append(dict(
+                id     = package['id'],
+                label  = package['label'],
+                fields = fields,
+                files  = sorted(package_files.get(str(package['id']), []), key=lambda f: f['name'])
+                ))
+
+        self.download_files(list(files.values()))
+
+        # Lets rndflow.job answer queries about inputs without scanning and parsing in/
+        write_json(self.root / 'in' / INDEX_FILE, dict(
+            lazy     = bool(lazy),
+            params   = params,
+            packages = sorted(index_packages, key=lambda p: str(p['id'])),
+            files    = input_files,
+            ))
+
+        if lazy:
+            lazy_files = [f for _, f in lazy.values()]
+            self.prefetcher = InputPrefetcher(self.server, self.root, lazy_files, self.logger, self.metrics)
+            self.prefetcher.start()
+            self.logger.info('Job inputs metadata ready, %s files are downloaded in background.', len(lazy_files))
+        else:
+            self.logger.info('Job inputs data downloaded.')
 
         try:
             self.server.post(f'/executor_api/jobs/{self.job_id}/status', json=dict(status='downloaded'))
         except Exception as e:
             raise PossibleNetworkError(f"Could not send 'Downloaded' status to server: {str(e)}") from None
 
+    def check_free_space(self, files):
+        """
+        Fail before any transfer if the files (by the sizes in the job file list) do not fit on disk.
+        """
+        expected = sum(f.get('size') or 0 for f in files)
+        free = shutil.disk_usage(self.root).free
+        self.logger.info('Job inputs: %s files, %s bytes expected, %s bytes free on disk.', len(files), expected, free)
+
+        if self.cfg.download_check_space and expected + self.cfg.download_space_reserve > free:
+            raise JobLimitError(f'Not enough disk space for job inputs: {expected} bytes needed, {free} bytes free '
+                    f'({self.cfg.download_space_reserve} bytes reserved, download_space_reserve)')
+
+    def download_file(self, folder, f, cancel=None):
+        stats = self.server.download(f, folder=folder, cancel=cancel)
+        self.metrics.add('download.files')
+        self.metrics.add('download.bytes', stats['bytes'])
+        self.metrics.add('download.retries', stats['retries'])
+        if stats['cached']:
+            self.metrics.add('download.cached')
+            self.metrics.add('download.cached_bytes', f.get('size') or 0)
+
+    def download_files(self, files):
+        """
+        Download (folder, file) pairs on download_workers threads. Largest files
+        are started first and small ones fill the workers that become idle,
+        so a big file does not end up alone at the end of the phase. The first
+        error aborts the transfers in progress.
+        """
+        files = sorted(files, key=lambda pf: pf[1].get('size') or 0, reverse=True)
+        expected = sum(f.get('size') or 0 for _, f in files)
+        self.metrics.set('download.expected_bytes', expected)
+
+        cancel = Event()
+        with ThreadPoolExecutor(max(1, self.cfg.download_workers)) as executor:
+            futures = [executor.submit(self.download_file, p, f, cancel) for p, f in files]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                cancel.set()
+                for future in futures:
+                    future.cancel()
+                raise
+
+        counters = self.metrics.as_dict()['counters']
+        self.logger.info('Downloaded %s bytes of %s expected (%s bytes from the object cache).',
+                counters.get('download.bytes', 0), expected, counters.get('download.cached_bytes', 0))
+
     def execute(self):
         env = os.environ.copy()
-        env.pop('RNDFLOW_REFRESH_TOKEN')
+        env.pop('RNDFLOW_REFRESH_TOKEN', None)
 
         base_url = os.environ.get('JUPYTER_BASE_URL')
 
@@ -139,100 +305,185 @@ class Job:
             exit $rc
             """)
 
-        p = subprocess.run(script_wrapper, cwd=self.root, shell=True, executable="/bin/bash", check=False)
-        self.status = p.returncode
+        streamer = None
+        if self.cfg.stream_outputs:
+            streamer = OutputStreamer(self.root, self.stream_upload, self.scan_rules(), self.logger,
+                    interval=self.cfg.stream_poll_interval, stable=self.cfg.stream_stable_seconds)
 
-    def upload(self):
-        self.logger.info('Uploading job output to server and S3 server...')
-
-        exclude_dirs = ('in', '__pycache__', '.ipynb_checkpoints')
-        def enumerate_files():
-            for directory, dirs, files in os.walk(self.root):
-                path = Path(directory)
-                dirs[:] = [d for d in dirs
-                    if (path / d).relative_to(self.root).parts[0] not in exclude_dirs]
-                for f in files:
-                    if self.root / f != self.log_file:
-                        yield path / f
-
-        def upload_files(paths):
+        with self.metrics.phase('execute'), \
+                subprocess.Popen(script_wrapper, cwd=self.root, shell=True, executable="/bin/bash") as p:
+            self.resources.start(p.pid)
+            if streamer is not None:
+                streamer.start(p.pid)
+            try:
+                self.status = p.wait()
+            finally:
+                self.resources.stop()
+                if streamer is not None:
+                    streamer.stop()
+                    shutil.rmtree(self.root / STREAM_DIR, ignore_errors=True)
+
+        self.resources.write(self.artefacts / 'resources.json')
+        if self.resources.summary() is not None:
+            self.logger.info('Job resources: %s', self.resources.summary())
+
+    def write_metrics(self):
+        try:
+            self.metrics.write_json(self.artefacts / 'metrics.json')
+            if self.cfg.metrics_prometheus_file:
+                self.metrics.write_prometheus(self.cfg.metrics_prometheus_file)
+        except Exception as e:
+            self.logger.error('Could not write job metrics: %s', e)
+
+    def scan_rules(self):
+        rules = ScanRules(DEFAULT_EXCLUDE + (f'/{STREAM_DIR}/',) + tuple(self.cfg.upload_exclude))
+        rules.add_file(self.root / self.cfg.upload_ignore_file)
+        for pattern in self.cfg.upload_include:
+            rules.add(f'!{pattern}')
+        return rules
+
+    def fingerprint(self, path, stat):
+        key = (stat.st_size, stat.st_mtime_ns)
+        cached = self.hashes.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        h = file_hash(path)
+        self.hashes[path] = (key, h)
+        return h
+
+    def upload_file_to_s3(self, link, path, size=None):
+        if link is None:
+            return False
+
+        _, file_type = get_binary_and_type(path)
+        if size is None:
+            size = path.stat().st_size
+        try:
+            with open(path, 'rb') as f:
+                r = self.server.raw_session.put(link, data=f, headers={
+                    'Content-Type': file_type,
+                    'Content-Length': str(size)
+                    })
+                r.raise_for_status()
+        except Exception as e:
+            raise PossibleNetworkError(f"Could not upload file [{path}] to server: {str(e)}") from None
 
-            def get_binary_and_type(path):
-                binary = is_binary(str(path))
+        self.metrics.add('upload.objects')
+        self.metrics.add('upload.bytes', size)
+        self.metrics.add('upload.retries', response_retries(r))
 
-                file_type, _ = mimetypes.guess_type(str(path))
-                if file_type is None:
-                    file_type = 'application/x-binary' if binary else 'text/plain'
+        return True
 
-                return binary, file_type
+    def upload_objects(self, h2p, sizes):
+        """
+        Upload the objects (content hash -> path) that are not yet on the server.
+        """
+        objects = [h for h in h2p if h not in self.uploaded]
+        if not objects:
+            return
 
-            def upload_file_to_s3(link, path):
-                if link is None:
-                    return False
+        try:
+            links  = self.server.spec_post(f'/executor_api/jobs/{self.job_id}/upload_objects',
+                json={ 'objects': objects })
+        except Exception as e:
+            raise PossibleNetworkError(f"Could not get links for uploading data to S3 server: {str(e)}") from None
+
+        self.logger.info('Uploading %s files to S3 server...', len(links))
+
+        for item in links:
+            path = h2p[item['object_id']]
+            link = item['link']
+
+            if self.upload_file_to_s3(link, path, sizes.get(path)):
+                self.logger.info('Uploaded %s file to S3 server.', path)
+            else:
+                self.logger.info('Skipping uploading %s file to S3 server.', path)
+                self.metrics.add('upload.skipped')
+
+            self.uploaded.add(item['object_id'])
+
+    @staticmethod
+    def snapshot(path, directory):
+        """
+        Copy a file the script may still be writing and hash the copied bytes,
+        so that the uploaded object always matches its content hash. The
+        suffix is kept for the Content-Type of the upload.
+        """
+        h = hashlib.sha256()
+        with open(path, 'rb') as src, tempfile.NamedTemporaryFile(dir=directory, suffix=Path(path).suffix, delete=False) as dst:
+            for chunk in iter(lambda: src.read(65536), b''):
+                h.update(chunk)
+                dst.write(chunk)
+        return h.hexdigest(), Path(dst.name)
+
+    def stream_upload(self, entries):
+        # Inside the job root (same filesystem as the outputs), excluded by scan_rules()
+        directory = self.root / STREAM_DIR
+        directory.mkdir(exist_ok=True)
+
+        count = len(self.uploaded)
+        for entry in entries:
+            state = (entry.stat.st_size, entry.stat.st_mtime_ns)
+            h, copy = self.snapshot(entry.path, directory)
+            try:
+                stat = entry.path.stat()
+                if (stat.st_size, stat.st_mtime_ns) == state:
+                    # The copy is the scanned state of the file: the final upload need not hash it again
+                    self.hashes[entry.path] = (state, h)
 
-                _, file_type = get_binary_and_type(path)
-                try:
-                    with open(path, 'rb') as f:
-                        self.server.raw_session.put(link, data=f, headers={
-                            'Content-Type': file_type,
-                            'Content-Length': str(path.stat().st_size)
-                            }).raise_for_status()
-                except Exception as e:
-                    raise PossibleNetworkError(f"Could not upload file [{path}] to server: {str(e)}") from None
+                self.logger.info('Streaming %s ...', entry.path)
+                self.upload_objects({h: copy}, {copy: copy.stat().st_size})
+            finally:
+                copy.unlink(missing_ok=True)
 
-                return True
+        self.metrics.add('execute.streamed', len(self.uploaded) - count)
 
-            p2h = {Path(path) : file_hash(path) for path in paths}
+    def upload(self):
+        self.logger.info('Uploading job output to server and S3 server...')
 
-            self.logger.info('Get links for  uploading  %s files to S3 server...', len(p2h))
+        # The uploaded copy has download and execution metrics, the local one is completed after upload
+        self.write_metrics()
 
-            h2p = {h : p for p,h in p2h.items()}
-            try:
-                links  = self.server.spec_post(f'/executor_api/jobs/{self.job_id}/upload_objects',
-                    json={ 'objects': list(h2p.keys()) })
-            except Exception as e:
-                raise PossibleNetworkError(f"Could not get links for uploading data to S3 server: {str(e)}") from None
+        entries = scan_files(self.root, self.scan_rules(), skip=[self.log_file],
+                max_files=self.cfg.upload_max_files, max_bytes=self.cfg.upload_max_bytes)
+        stats = {entry.path : entry.stat for entry in entries}
 
-            self.logger.info('Uploading %s files to S3 server...', len(links))
+        with self.metrics.phase('hash'):
+            p2h = {path : self.fingerprint(path, stat) for path, stat in stats.items()}
+        self.metrics.set('upload.files', len(p2h))
 
-            for item in links:
-                path = h2p[item['object_id']]
-                link = item['link']
+        self.logger.info('Get links for  uploading  %s files to S3 server...', len(p2h))
 
-                if upload_file_to_s3(link, path):
-                    self.logger.info('Uploaded %s file to S3 server.', path)
-                else:
-                    self.logger.info('Skipping uploading %s file to S3 server.', path)
+        self.upload_objects({h : p for p,h in p2h.items()}, {p : s.st_size for p,s in stats.items()})
 
-            self.logger.info('All files uploaded to S3 server.')
+        self.logger.info('All files uploaded to S3 server.')
 
-            self.logger.info('Uploading log file to S3 server (get link and uploading)...')
+        self.logger.info('Uploading log file to S3 server (get link and uploading)...')
 
-            try:
-                log_link = self.server.post(f'/executor_api/jobs/{self.job_id}/upload_objects', json={ 'objects': [file_hash(self.log_file)], 'check_exists': False })
-            except Exception as e:
-                raise PossibleNetworkError(f"Could not get link for uploading log to S3 server : {str(e)}") from None
-            # Do not put any log output here! Log file size will be incorrect!
-            upload_file_to_s3(log_link[0]['link'], self.log_file)
-            p2h[self.log_file] = file_hash(self.log_file)
-            # Do not put any log output here! Log file size will be incorrect!
-            files = []
-            for path,h in p2h.items():
-                binary, file_type = get_binary_and_type(path)
-                files.append(dict(
-                    name          = str(path.relative_to(self.root)),
-                    type          = file_type,
-                    content_hash  = h,
-                    is_executable = os.access(path, os.X_OK),
-                    is_binary     = binary,
-                    size          = path.stat().st_size
-                    ))
-
-            return files
-
-        files = upload_files(enumerate_files())
+        try:
+            log_link = self.server.post(f'/executor_api/jobs/{self.job_id}/upload_objects', json={ 'objects': [file_hash(self.log_file)], 'check_exists': False })
+        except Exception as e:
+            raise PossibleNetworkError(f"Could not get link for uploading log to S3 server : {str(e)}") from None
+        # Do not put any log output here! Log file size will be incorrect!
+        self.upload_file_to_s3(log_link[0]['link'], self.log_file)
+        p2h[self.log_file] = file_hash(self.log_file)
+        # Do not put any log output here! Log file size will be incorrect!
+        files = []
+        for path,h in p2h.items():
+            binary, file_type = get_binary_and_type(path)
+            stat = stats[path] if path in stats else path.stat()
+            files.append(dict(
+                name          = str(path.relative_to(self.root)),
+                type          = file_type,
+                content_hash  = h,
+                is_executable = bool(stat.st_mode & 0o111),
+                is_binary     = binary,
+                size          = stat.st_size
+                ))
 
         self.logger.info('Uploading info to the server for creating output packages...')
+        # Sent synchronously: the server must have the final log tail before the status changes
         self.heartbeat_send()
 
         try:
@@ -248,28 +499,39 @@ class Job:
         self.logger.info('Jobs data uploading completed.')
         # self.heartbeat_send() # This heartbeat will be ignored by the server since the job will be proceed.
 
+    def stop_prefetch(self):
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+
     def stop(self):
+        self.stop_prefetch()
         self.done.set()
         self.heartbeat_sleep.set()
         self.heartbeat_thread.join()
+        close_file_logger(self.logger, self.log_file)
 
     def __enter__(self):
         try:
-            self.download()
+            # With lazy inputs most input bytes are counted by the prefetch phase
+            with self.metrics.phase('download', throughput=not self.cfg.lazy_inputs):
+                self.download()
             return self
         except Exception as e:
-            self.stop()
-            message = e.message if isinstance(e, PossibleNetworkError) else traceback.format_exc()
+            message = e.message if isinstance(e, (PossibleNetworkError, JobLimitError)) else traceback.format_exc()
             self.logger.error('Download error: %s', message)
+            self.stop()
             self.server.post(f'/executor_api/jobs/{self.job_id}/error', json=dict(
                         error='DownloadError', message=message))
             raise e
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         try:
-            self.upload()
+            self.stop_prefetch() # Inputs the script did not ask for are not needed anymore
+            with self.metrics.phase('upload'):
+                self.upload()
         except Exception as e:
-            message = e.message if isinstance(e, PossibleNetworkError) else traceback.format_exc()
+            message = e.message if isinstance(e, (PossibleNetworkError, JobLimitError)) else traceback.format_exc()
             self.logger.error('Upload error: %s', message)
             con_tries = 0
             #If data was uploaded then ignore the error else try send info abotu error.
@@ -284,18 +546,65 @@ class Job:
                     time.sleep(600)
                     con_tries +=1
         finally:
+            self.write_metrics()
+            self.logger.info('Job metrics: %s', self.metrics.summary())
             self.stop()
 
+#---------------------------------------------------------------------------
+def read_job_ids(stream):
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield int(line)
+
+#---------------------------------------------------------------------------
+def run_worker(host, job_ids, cleanup=False):
+    """
+    Run jobs one after another in this process. The server connection (with
+    its sessions, connection pools and tokens) and the object cache are shared,
+    every job has its own directory and log file.
+    """
+    server = Server(host, cfg=settings())
+
+    failed = 0
+    for job_id in job_ids:
+        logger.info('Worker: starting job %s', job_id)
+        try:
+            with Job(host, job_id, server=server) as job:
+                job.execute()
+        except Exception as e: # Already reported to the server by the job
+            logger.error('Worker: job %s failed: %s', job_id, e)
+            failed += 1
+        finally:
+            if cleanup:
+                shutil.rmtree(Path(str(job_id)).resolve(), ignore_errors=True)
+            if server.object_cache is not None:
+                server.object_cache.trim()
+
+    return failed
+
 #---------------------------------------------------------------------------
 def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--host', dest='host', required=True)
-    parser.add_argument('--job', dest='job', required=True, type=int)
+    parser.add_argument('--job', dest='job', type=int, nargs='*',
+        help='Job id. Several ids or, with --worker, none to read them from stdin one per line')
+    parser.add_argument('--worker', action='store_true',
+        help='Run jobs one after another in this process, reusing server connections and caches')
+    parser.add_argument('--cleanup', action='store_true',
+        help='Worker mode: remove the job directory after the job')
     args = parser.parse_args()
 
+    if not args.worker and len(args.job or ()) != 1:
+        parser.error('--job requires exactly one id without --worker')
+
     if 'RNDFLOW_REFRESH_TOKEN' not in os.environ:
         raise Exception('Access token not found in environment')
 
-    with Job(args.host, args.job) as job:
+    if args.worker:
+        job_ids = args.job or read_job_ids(sys.stdin)
+        sys.exit(1 if run_worker(args.host, job_ids, args.cleanup) else 0)
+
+    with Job(args.host, args.job[0]) as job:
         job.execute()
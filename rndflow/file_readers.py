@@ -2,6 +2,8 @@ import json
 from pathlib import Path
 import h5py
 import pandas
+
+from .serializer import read_json
 file_readers = {}
 
 #---------------------------------------------------------------------------
@@ -48,6 +50,8 @@ def load_hdf5(path):
 
 #---------------------------------------------------------------------------
 def load_json(path, encoding='utf-8'):
+    if encoding.lower().replace('-', '') == 'utf8':
+        return read_json(path)
     return json.loads(Path(path).read_text(encoding=encoding))
 
 #---------------------------------------------------------------------------
@@ -1,16 +1,27 @@
 import os
-import json
+import copy
+import shutil
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
+from threading import Lock
 import h5py
 import numpy
 
+from .config import settings
 from .file_readers import file_readers
+from .load_cache import LoadCache
+from .serializer import NumpyEncoder, read_json, write_json # pylint: disable=unused-import #(NumpyEncoder is public)
+from .prefetch import INDEX_FILE, FAILED_FILE, REQUEST_DIR, request_id
 
 from .logger import logger
 
 root = Path('.').resolve()
 job_id = int(root.name)  # pylint: disable=invalid-name #(historical)
 package_index = 0        # pylint: disable=invalid-name #(historical)
+_package_lock = Lock()
+_load_cache = LoadCache(settings().load_cache_bytes) if settings().load_cache_bytes > 0 else None # pylint: disable=invalid-name
 
 #---------------------------------------------------------------------------
 def secret(name, default=None):
@@ -20,30 +31,138 @@ def secret(name, default=None):
         raise Exception(f'The required environment variable "{vname}" is not set')
     return default if value is None else value
 
+#---------------------------------------------------------------------------
+@lru_cache(maxsize=None)
+def _input_index():
+    """
+    Input index written by the executor (params, packages and their files).
+    Empty when the job directory was prepared without it.
+    """
+    path = root / 'in' / INDEX_FILE
+    if path.is_file():
+        return read_json(path)
+    return {}
+
+#---------------------------------------------------------------------------
+@lru_cache(maxsize=None)
+def _indexed_packages():
+    return {p['id']: Package(root / 'in' / str(p['id']), p) for p in _input_index().get('packages', [])}
+
+#---------------------------------------------------------------------------
+@lru_cache(maxsize=None)
+def _input_hashes():
+    return {f['name']: f['content_hash'] for f in _input_index().get('files', [])}
+
+#---------------------------------------------------------------------------
+def enable_load_cache(max_bytes=1 << 30):
+    """
+    Keep decoded input files in memory, so repeated load() calls (e.g. notebook
+    cells) do not read and decode them again. Cached numpy arrays are returned
+    read-only and shared between calls; pandas objects are copied.
+    """
+    global _load_cache # pylint: disable=global-statement
+    _load_cache = LoadCache(max_bytes)
+    return _load_cache
+
+#---------------------------------------------------------------------------
+def disable_load_cache():
+    global _load_cache # pylint: disable=global-statement
+    _load_cache = None
+
+#---------------------------------------------------------------------------
+def _read(path, reader):
+    def decode():
+        return reader(fetch(path))
+
+    if _load_cache is None:
+        return decode()
+
+    try:
+        key = _input_hashes()[path.relative_to(root).as_posix()]
+    except (KeyError, ValueError):
+        # Not an indexed input: identify the content by the file state
+        stat = path.stat()
+        key = (str(path), stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    return _load_cache.get((key, reader), decode)
+
+#---------------------------------------------------------------------------
+@lru_cache(maxsize=None)
+def _lazy_files():
+    index = _input_index()
+    return frozenset(f['name'] for f in index.get('files', [])) if index.get('lazy') else frozenset()
+
+#---------------------------------------------------------------------------
+def fetch(path):
+    """
+    Wait until the input file is downloaded and return its path.
+
+    Only needed when the executor starts the job before its inputs are
+    downloaded (lazy_inputs setting): the file is moved to the head of the
+    download queue. load() does this for every file it reads; call fetch()
+    before opening a path from files() or Package.files() directly.
+    """
+    path = Path(path)
+    if path.exists():
+        return path
+
+    try:
+        name = path.resolve().relative_to(root).as_posix()
+    except ValueError:
+        return path
+
+    if name not in _lazy_files():
+        return path
+
+    requests = root / 'in' / REQUEST_DIR
+    requests.mkdir(parents=True, exist_ok=True)
+    (requests / request_id(name)).write_text(name, encoding='utf-8')
+
+    failed = root / 'in' / FAILED_FILE
+    while not path.exists():
+        if failed.is_file():
+            raise Exception(f'Could not download {name}: {failed.read_text(encoding="utf-8")}')
+        time.sleep(0.05)
+
+    return path
+
 #---------------------------------------------------------------------------
 class Package:
-    def __init__(self, path):
+    def __init__(self, path, meta=None):
         self.path = path
+        self.meta = meta  # Input index entry, None when the package is read from the directory
 
     @property
     def id(self):
+        if self.meta is not None:
+            return self.meta['id']
         return int(self.path.name)
 
     @property
     def label(self):
+        if self.meta is not None:
+            return self.meta['label'].strip()
+
         path = self.path / 'label'
         if path.is_file():
             return path.read_text().strip()
 
     def files(self, *suffixes):
-        return [f for f in sorted((self.path / 'files').glob('*'))
-                if f.is_file() and (not suffixes or f.suffix.lower() in suffixes) ]
+        if self.meta is not None:
+            paths = [self.path / 'files' / f['name'] for f in self.meta['files']]
+        else:
+            paths = [f for f in sorted((self.path / 'files').glob('*')) if f.is_file()]
+
+        return [f for f in paths if not suffixes or f.suffix.lower() in suffixes]
 
     @property
     def fields(self):
+        if self.meta is not None:
+            return copy.deepcopy(self.meta['fields'])
+
         path = self.path / 'fields.json'
         if path.is_file():
-            return json.loads(path.read_text())
+            return read_json(path)
         return {}
 
     def load(self, readers=None):
@@ -55,30 +174,42 @@ class Package:
         for f in self.files():
             reader = readers.get(f.suffix.lower())
             if reader:
-                data[f.stem] = reader(f)
+                data[f.stem] = _read(f, reader)
             else:
                 logger.warning('Skipping %s: unknown format', f)
 
         return data
 
-#---------------------------------------------------------------------------
-class NumpyEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, numpy.generic):
-            return o.item()
-
-        return super().default(o)
-
 #---------------------------------------------------------------------------
 def params():
+    index = _input_index()
+    if 'params' in index:
+        return copy.deepcopy(index['params'])
+
     path = root / 'in' / 'params.json'
     if path.is_file():
-        return json.loads(path.read_text())
+        return read_json(path)
     return {}
 
 #---------------------------------------------------------------------------
 def packages():
-    return [Package(p) for p in sorted((root / 'in').glob('*')) if p.is_dir()]
+    if 'packages' in _input_index():
+        return list(_indexed_packages().values())
+
+    return [Package(p) for p in sorted((root / 'in').glob('*')) if p.is_dir() and p.name.isdigit()]
+
+#---------------------------------------------------------------------------
+def package(package_id):
+    """
+    Input package by its id. Raises KeyError if the job has no such package.
+    """
+    if 'packages' in _input_index():
+        return _indexed_packages()[int(package_id)]
+
+    path = root / 'in' / str(package_id)
+    if not path.is_dir():
+        raise KeyError(package_id)
+    return Package(path)
 
 #---------------------------------------------------------------------------
 def files(*suffixes):
@@ -105,7 +236,106 @@ def save_hdf5(path, data):
                 compression='gzip' if isinstance(data, numpy.ndarray) else None)
 
 #---------------------------------------------------------------------------
-def save_package(label=None, files=None, fields=None, images=None):
+def _reset_package_lock():
+    global _package_lock # pylint: disable=global-statement
+    _package_lock = Lock() # Another thread could hold the lock when the process was forked
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_package_lock)
+
+#---------------------------------------------------------------------------
+def _last_package_index(out):
+    with os.scandir(out) as entries:
+        return max((int(e.name) for e in entries if e.name.isdigit()), default=0)
+
+#---------------------------------------------------------------------------
+def allocate_package(index=None):
+    """
+    Create the directory for a new output package and return its path.
+
+    Directories are claimed with an atomic mkdir, so threads and worker
+    processes (forked or spawned) calling save_package concurrently never
+    share a directory. Automatic numbers follow the allocation order, which
+    is not deterministic when several threads or processes save packages at
+    once. For a reproducible numbering pass index explicitly (e.g. the task
+    number in a process pool); FileExistsError is raised if that package
+    directory already exists.
+    """
+    global package_index # pylint: disable=global-statement
+
+    out = root / 'out'
+    out.mkdir(parents=True, exist_ok=True)
+
+    if index is not None:
+        path = out / str(index)
+        try:
+            path.mkdir()
+        except FileExistsError:
+            raise FileExistsError(f'Output package {index} already exists: {path}') from None
+        return path
+
+    with _package_lock:
+        while True:
+            package_index += 1
+            path = out / str(package_index)
+            try:
+                path.mkdir()
+                return path
+            except FileExistsError:
+                # Taken by another process: continue after the last existing package
+                package_index = max(package_index, _last_package_index(out))
+
+#---------------------------------------------------------------------------
+def save_image(path, image, options=None):
+    """
+    Save a matplotlib or plotly figure (or call image(path)).
+
+    Options:
+        format       matplotlib: file format/suffix, png by default.
+                     plotly: 'plt' (figure JSON, default) or 'html'
+        dpi          matplotlib resolution
+        transparent  matplotlib transparent background, True by default
+        compact      plotly html: load plotly.js from a CDN instead of embedding it
+
+    Returns False if the image type is unknown.
+    """
+    options = options or {}
+    fmt = options.get('format')
+
+    if callable(image):
+        image(path)
+    elif image.__module__.startswith('matplotlib'):
+        if fmt:
+            path = path.with_suffix(f'.{fmt}')
+        elif not path.suffix:
+            path = path.with_suffix('.png')
+        image.savefig(path, transparent=options.get('transparent', True), dpi=options.get('dpi'))
+    elif image.__module__.startswith('plotly'):
+        if fmt == 'html':
+            image.write_html(str(path.with_suffix('.html')),
+                include_plotlyjs='cdn' if options.get('compact', False) else True)
+        else:
+            image.write_json(str(path.with_suffix('.plt')))
+    else:
+        return False
+
+    return True
+
+#---------------------------------------------------------------------------
+def save_package(label=None, files=None, fields=None, images=None,
+        image_options=None, image_defaults=None, workers=None, index=None):
+    """
+    Save an output package to out/<n>, see allocate_package(). Safe to call
+    from several threads and processes.
+
+    images are saved with save_image(); image_options maps image names to
+    their options, image_defaults applies to all images. With workers (a
+    number of threads or a concurrent.futures Executor) plotly figures and
+    callables are saved concurrently. matplotlib is not thread-safe, so its
+    figures are rendered in the calling thread unless workers is a
+    ProcessPoolExecutor, which renders figures (but not callables, which
+    often can not be pickled and are run in the calling thread) in parallel.
+    """
     if files is None:
         files = {}
     if fields is None:
@@ -113,12 +343,17 @@ def save_package(label=None, files=None, fields=None, images=None):
     if images is None:
         images = {}
 
-    global package_index
+    path = allocate_package(index)
+    try:
+        _write_package(path, label, files, fields, images, image_options, image_defaults, workers)
+    except BaseException:
+        shutil.rmtree(path, ignore_errors=True) # A half-written package must not be uploaded
+        raise
 
-    package_index += 1
-    path = root / 'out' / str(package_index)
-    path.mkdir(parents=True, exist_ok=True)
+    return path
 
+#---------------------------------------------------------------------------
+def _write_package(path, label, package_files, fields, images, image_options, image_defaults, workers):
     if label is not None:
         (path / 'label').write_text(str(label).strip())
 
@@ -126,12 +361,12 @@ def save_package(label=None, files=None, fields=None, images=None):
         if not isinstance(fields, dict):
             raise ValueError('fields parameter should be a dictionary')
 
-        (path / 'fields.json').write_text(json.dumps(fields, ensure_ascii=False, cls=NumpyEncoder))
+        write_json(path / 'fields.json', fields)
 
-    if files or images:
+    if package_files or images:
         (path / 'files').mkdir(parents=True, exist_ok=True)
 
-    for k,v in files.items():
+    for k,v in package_files.items():
         f = path / 'files' / k
 
         if callable(v):
@@ -139,19 +374,33 @@ def save_package(label=None, files=None, fields=None, images=None):
         else:
             save_hdf5(f.with_suffix('.h5'), v)
 
-    for k,v in images.items():
-        f = path / 'files' / k
-        if callable(v):
-            v(f)
-        elif v.__module__.startswith('matplotlib'):
-            if not f.suffix:
-                f = f.with_suffix('.png')
-            v.savefig(f, transparent=True)
-        elif v.__module__.startswith('plotly'):
-            v.write_json(str(f.with_suffix('.plt')))
-
-        else:
+    image_options = image_options or {}
+    image_defaults = image_defaults or {}
+
+    def options(k):
+        return {**image_defaults, **image_options.get(k, {})}
+
+    if workers is None or not images:
+        saved = {k: save_image(path / 'files' / k, v, options(k)) for k,v in images.items()}
+    else:
+        executor = workers if isinstance(workers, Executor) else ThreadPoolExecutor(workers)
+        processes = isinstance(executor, ProcessPoolExecutor)
+
+        def submit(image):
+            if callable(image):
+                return not processes # Closures and lambdas can not be sent to another process
+            return processes or not image.__module__.startswith('matplotlib')
+
+        try:
+            futures = {k: executor.submit(save_image, path / 'files' / k, v, options(k))
+                    for k,v in images.items() if submit(v)}
+            saved = {k: save_image(path / 'files' / k, v, options(k))
+                    for k,v in images.items() if k not in futures}
+            saved.update({k: f.result() for k,f in futures.items()})
+        finally:
+            if executor is not workers:
+                executor.shutdown()
+
+    for k, ok in saved.items():
+        if not ok:
             logger.warning('Skipped image %s: unknown format', k)
-
-
-    return path
@@ -0,0 +1,96 @@
+import sys
+from collections import OrderedDict
+from threading import RLock
+
+import numpy
+import pandas
+
+#---------------------------------------------------------------------------
+def freeze(value):
+    """
+    Make numpy arrays inside the value read-only, so that a cached object can
+    be handed out to several callers without copying the arrays.
+    """
+    if isinstance(value, numpy.ndarray):
+        value.setflags(write=False)
+    elif isinstance(value, dict):
+        for v in value.values():
+            freeze(v)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            freeze(v)
+    return value
+
+#---------------------------------------------------------------------------
+def share(value):
+    """
+    Copy of the cached value for a caller: containers are new, read-only
+    arrays are shared, pandas objects (which can not be made read-only) are copied.
+    """
+    if isinstance(value, dict):
+        return {k: share(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [share(v) for v in value]
+    if isinstance(value, (pandas.DataFrame, pandas.Series)):
+        return value.copy()
+    return value
+
+#---------------------------------------------------------------------------
+def size_of(value):
+    if isinstance(value, numpy.ndarray):
+        return value.nbytes
+    if isinstance(value, pandas.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, pandas.Series):
+        return int(value.memory_usage(index=True, deep=True))
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(size_of(k) + size_of(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(size_of(v) for v in value)
+    return sys.getsizeof(value)
+
+#---------------------------------------------------------------------------
+class LoadCache:
+    """
+    In-process LRU cache of decoded input files, bounded by the estimated
+    memory size of the cached objects. Keys are (content key, reader).
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()  # key -> (value, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = RLock()
+
+    def get(self, key, load):
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return share(item[0])
+            self.misses += 1
+
+        value = freeze(load())
+        size = size_of(value)
+
+        with self.lock:
+            if size <= self.max_bytes and key not in self.items:
+                self.items[key] = (value, size)
+                self.size += size
+                while self.size > self.max_bytes:
+                    _, (_, evicted) = self.items.popitem(last=False)
+                    self.size -= evicted
+
+        return share(value)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return dict(items=len(self.items), bytes=self.size, max_bytes=self.max_bytes,
+                    hits=self.hits, misses=self.misses)
@@ -1,17 +1,17 @@
 import logging
+import os
 import sys
-from .config import Settings
-
-_cfg = Settings()
+from .config import settings
 
 #---------------------------------------------------------------------------
 def _make_stdout_logger(name='rndflow-job'):
-    level = logging.getLevelName(_cfg.logging_level)
+    cfg = settings()
+    level = logging.getLevelName(cfg.logging_level)
     log = logging.getLogger(name)
     log.setLevel(level)
     cnl = logging.StreamHandler(sys.stdout)
     cnl.setLevel(level)
-    fmt = logging.Formatter('[%(asctime)s] %(message)s', _cfg.dateformat)
+    fmt = logging.Formatter('[%(asctime)s] %(message)s', cfg.dateformat)
     cnl.setFormatter(fmt)
     log.addHandler(cnl)
     return log
@@ -21,19 +21,34 @@ logger = _make_stdout_logger()
 #---------------------------------------------------------------------------
 
 def make_file_stdout_logger(file, name='rndflow-job'):
-    level = logging.getLevelName(_cfg.logging_level)
+    """
+    Logger writing to stdout and to the file. The stdout handler is added once
+    per logger, so several jobs run in one process (rndflow-execute --worker)
+    do not repeat every line. Remove the file handler with close_file_logger.
+    """
+    cfg = settings()
+    level = logging.getLevelName(cfg.logging_level)
 
     log = logging.getLogger(name)
     log.setLevel(level)
-    cnl = logging.StreamHandler(sys.stdout)
-    cnl.setLevel(level)
+    fmt = logging.Formatter('[%(asctime)s] %(message)s', cfg.dateformat)
+
+    if not any(type(h) is logging.StreamHandler and h.stream is sys.stdout for h in log.handlers): # pylint: disable=unidiomatic-typecheck
+        cnl = logging.StreamHandler(sys.stdout)
+        cnl.setLevel(level)
+        cnl.setFormatter(fmt)
+        log.addHandler(cnl)
+
     cnf = logging.FileHandler(file)
     cnf.setLevel(level)
-
-    fmt = logging.Formatter('[%(asctime)s] %(message)s', _cfg.dateformat)
-    cnl.setFormatter(fmt)
     cnf.setFormatter(fmt)
-    log.addHandler(cnl)
     log.addHandler(cnf)
 
     return log
+
+def close_file_logger(log, file):
+    path = os.path.abspath(file)
+    for handler in list(log.handlers):
+        if isinstance(handler, logging.FileHandler) and handler.baseFilename == path:
+            log.removeHandler(handler)
+            handler.close()
@@ -0,0 +1,96 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+
+#---------------------------------------------------------------------------
+class JobMetrics:
+    """
+    Durations of job phases and counters attributed to them.
+
+    Counters are named '<phase>.<counter>', e.g. 'download.bytes'.
+    """
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.phases = {}
+        self.counters = {}
+        self.lock = Lock()
+
+    @contextmanager
+    def phase(self, name, throughput=True):
+        """
+        Time a phase. With throughput=False <phase>.bytes_per_second is not
+        reported: the phase bytes cover only a part of its work.
+        """
+        started_at = time.time()
+        start = time.monotonic()
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.phases[name] = dict(started_at=started_at, duration=time.monotonic() - start,
+                        throughput=throughput)
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        with self.lock:
+            self.counters[name] = value
+
+    def as_dict(self):
+        with self.lock:
+            phases = {}
+            for name, phase in self.phases.items():
+                phase = dict(phase)
+                nbytes = self.counters.get(f'{name}.bytes')
+                if phase.pop('throughput') and nbytes is not None and phase['duration'] > 0:
+                    phase['bytes_per_second'] = nbytes / phase['duration']
+                phases[name] = phase
+
+            return dict(job=self.job_id, phases=phases, counters=dict(self.counters))
+
+    def write_json(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.as_dict(), indent=2), encoding='utf-8')
+
+    def write_prometheus(self, path):
+        """
+        Write the metrics in the Prometheus text format (node_exporter textfile collector).
+        The file is replaced atomically so the collector never reads it half-written.
+        """
+        data = self.as_dict()
+        job = f'job_id="{self.job_id}"' # 'job' is the label Prometheus sets to the scrape job
+
+        lines = [
+            '# HELP rndflow_job_phase_seconds Duration of the job phase.',
+            '# TYPE rndflow_job_phase_seconds gauge',
+            ]
+        for name, phase in data['phases'].items():
+            lines.append(f'rndflow_job_phase_seconds{{{job},phase="{name}"}} {phase["duration"]:.6f}')
+
+        counters = {}
+        for name, value in data['counters'].items():
+            phase, _, counter = name.rpartition('.')
+            counters.setdefault(counter, []).append((phase, value))
+
+        for counter, values in sorted(counters.items()):
+            lines.append(f'# TYPE rndflow_job_{counter} gauge')
+            for phase, value in values:
+                lines.append(f'rndflow_job_{counter}{{{job},phase="{phase}"}} {value}')
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f'.{path.name}.{os.getpid()}')
+        tmp.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+        os.replace(tmp, path)
+
+    def summary(self):
+        data = self.as_dict()
+        return ', '.join(
+                [f'{name}: {phase["duration"]:.1f}s' for name, phase in data['phases'].items()] +
+                [f'{name}={value}' for name, value in data['counters'].items()])
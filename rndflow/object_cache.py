@@ -0,0 +1,71 @@
+import os
+import shutil
+from pathlib import Path
+from threading import get_ident
+
+#---------------------------------------------------------------------------
+class ObjectCache:
+    """
+    Downloaded files kept on local disk by content hash, so that a worker
+    running several jobs (or several workers sharing the directory) fetches
+    every object once. Files are copied in and out of the cache: a job may
+    change its input files in place. trim() removes the least recently used
+    objects until the cache fits into max_bytes.
+    """
+    def __init__(self, root, max_bytes):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+
+    def path(self, content_hash):
+        return self.root / content_hash[:2] / content_hash
+
+    def get(self, content_hash, dest):
+        """
+        Copy the object to dest. Returns False if it is not in the cache.
+        """
+        src = self.path(content_hash)
+        try:
+            shutil.copyfile(src, dest)
+            os.utime(src) # Recently used
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, content_hash, src):
+        dest = self.path(content_hash)
+        if dest.exists():
+            return
+
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_name(f'{dest.name}.{os.getpid()}.{get_ident()}.tmp')
+        try:
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, dest)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    def trim(self):
+        """
+        Remove least recently used objects over max_bytes. Returns bytes removed.
+        """
+        entries = []
+        total = 0
+        for directory in self.root.glob('??'):
+            with os.scandir(directory) as files:
+                for entry in files:
+                    if entry.name.endswith('.tmp') or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total - removed <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                removed += size
+            except FileNotFoundError:
+                pass # Removed by another worker
+        return removed
@@ -0,0 +1,102 @@
+import hashlib
+import os
+from contextlib import nullcontext
+from pathlib import Path
+from threading import Event, Thread
+
+#---------------------------------------------------------------------------
+# Files shared with rndflow.job in the script process
+INDEX_FILE   = '.index.json'   # in/.index.json: list of input files (see Job.download)
+PARTIAL_DIR  = '.partial'      # in/.partial/<hash>: files being downloaded
+REQUEST_DIR  = '.fetch'        # in/.fetch/<id>: names of files the script is waiting for
+FAILED_FILE  = '.failed'       # in/.failed: download error message
+
+def request_id(name):
+    return hashlib.sha1(name.encode('utf-8')).hexdigest()
+
+#---------------------------------------------------------------------------
+class InputPrefetcher:
+    """
+    Downloads job input files in the background while the script is running.
+
+    Files are fetched smallest first, except that files the script asked for
+    (see rndflow.job) jump the queue. Every file is downloaded to in/.partial
+    and then renamed into place, so a file that exists is always complete.
+    stop() aborts the transfer in progress.
+    """
+    def __init__(self, server, root, files, logger, metrics=None):
+        self.server = server
+        self.root = Path(root)
+        self.logger = logger
+        self.metrics = metrics
+        self.queue = sorted(files, key=lambda f: f.get('size') or 0)
+
+        self.inputs = self.root / 'in'
+        self.partial = self.inputs / PARTIAL_DIR
+        self.requests = self.inputs / REQUEST_DIR
+
+        self.error = None
+        self.cancelled = Event()
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.partial.mkdir(parents=True, exist_ok=True)
+        self.requests.mkdir(parents=True, exist_ok=True)
+        self.thread.start()
+
+    def stop(self):
+        self.cancelled.set()
+        self.thread.join()
+
+    def requested(self):
+        names = set()
+        with os.scandir(self.requests) as entries:
+            for entry in entries:
+                try:
+                    names.add(Path(entry.path).read_text(encoding='utf-8'))
+                except OSError:
+                    pass # Being written
+        return names
+
+    def next_file(self):
+        names = self.requested()
+        if names:
+            for i, f in enumerate(self.queue):
+                if f['name'] in names:
+                    return self.queue.pop(i)
+        return self.queue.pop(0)
+
+    def run(self):
+        phase = self.metrics.phase('prefetch') if self.metrics is not None else nullcontext()
+        try:
+            with phase:
+                self.transfer()
+        except Exception as e:
+            self.error = getattr(e, 'message', None) or str(e)
+            self.logger.error('Input download error: %s', self.error)
+            (self.inputs / FAILED_FILE).write_text(self.error, encoding='utf-8')
+
+    def transfer(self):
+        while self.queue and not self.cancelled.is_set():
+            f = self.next_file()
+            path = self.root / f['name']
+            tmp = self.partial / f['content_hash']
+
+            try:
+                stats = self.server.download(f, path=tmp, cancel=self.cancelled)
+            except Exception:
+                tmp.unlink(missing_ok=True)
+                if self.cancelled.is_set():
+                    return # Aborted by stop() (server.DownloadCancelled)
+                raise
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp, path)
+            (self.requests / request_id(f['name'])).unlink(missing_ok=True)
+
+            if self.metrics is not None:
+                self.metrics.add('prefetch.files')
+                self.metrics.add('prefetch.bytes', stats['bytes'])
+                self.metrics.add('prefetch.retries', stats['retries'])
+
+        if not self.queue:
+            self.logger.info('Job inputs data downloaded.')
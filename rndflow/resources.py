@@ -0,0 +1,250 @@
+import json
+import os
+import time
+from pathlib import Path
+from threading import Event, Lock, Thread
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+PROC = Path('/proc')
+
+try:
+    CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    CLOCK_TICKS = 100
+    PAGE_SIZE = 4096
+
+#---------------------------------------------------------------------------
+def read_proc_stat(pid):
+    """
+    Parent pid, start time, CPU seconds and RSS bytes from /proc/<pid>/stat.
+    """
+    text = (PROC / str(pid) / 'stat').read_text()
+    # Process name may contain spaces and parentheses: the fields start after the last ')'
+    fields = text[text.rindex(')') + 2:].split()
+    return dict(
+        ppid  = int(fields[1]),
+        start = int(fields[19]),
+        cpu   = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS,
+        rss   = int(fields[21]) * PAGE_SIZE,
+        )
+
+#---------------------------------------------------------------------------
+def children_usage():
+    """
+    CPU seconds and max RSS bytes of all terminated and waited-for descendants of this process.
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return dict(cpu=usage.ru_utime + usage.ru_stime, maxrss=usage.ru_maxrss * 1024) # ru_maxrss is in KiB
+
+#---------------------------------------------------------------------------
+def read_proc_io(pid):
+    io = dict(read_bytes=0, write_bytes=0)
+    try:
+        for line in (PROC / str(pid) / 'io').read_text().splitlines():
+            key, _, value = line.partition(':')
+            if key in io:
+                io[key] = int(value)
+    except (OSError, ValueError):
+        pass # Not permitted or the process has gone
+    return io
+
+#---------------------------------------------------------------------------
+def process_tree(pid):
+    """
+    Stat records of the process and all its descendants, keyed by pid.
+    """
+    stats = {}
+    for entry in PROC.iterdir():
+        if entry.name.isdigit():
+            try:
+                stats[int(entry.name)] = read_proc_stat(entry.name)
+            except (OSError, ValueError, IndexError):
+                pass # The process has gone
+
+    children = {}
+    for p, s in stats.items():
+        children.setdefault(s['ppid'], []).append(p)
+
+    tree = {}
+    queue = [pid]
+    while queue:
+        p = queue.pop()
+        if p in stats and p not in tree:
+            tree[p] = stats[p]
+            queue.extend(children.get(p, ()))
+
+    return tree
+
+#---------------------------------------------------------------------------
+def open_files(pid):
+    """
+    Paths of the files currently open by the process and its descendants.
+    """
+    paths = set()
+    for p in process_tree(pid):
+        try:
+            with os.scandir(PROC / str(p) / 'fd') as fds:
+                for fd in fds:
+                    try:
+                        paths.add(os.readlink(fd.path))
+                    except OSError:
+                        pass # Closed meanwhile
+        except OSError:
+            pass # Not permitted or the process has gone
+    return paths
+
+#---------------------------------------------------------------------------
+class ResourceSampler:
+    """
+    Polls CPU time, resident memory and disk I/O of a process tree via /proc.
+
+    The time series holds [seconds, cpu_seconds, rss_bytes, read_bytes, write_bytes]
+    points. When it grows over max_points every other point is dropped and the
+    sampling stride is doubled, so memory stays bounded for long jobs.
+
+    Polling misses whatever a process does after the last sample before it
+    exits. When the job process has been waited for, stop() completes the CPU
+    time and peak memory from getrusage(RUSAGE_CHILDREN).
+    """
+    def __init__(self, interval, max_points=2048):
+        self.interval = interval
+        self.max_points = max_points
+
+        self.pid = None
+        self.started = None
+        self.stopped = None
+        self.series = []
+        self.stride = 1
+        self.samples = 0
+
+        self.processes = {}  # (pid, start) -> last seen cumulative counters of live processes
+        self.exited = dict(cpu=0.0, read_bytes=0, write_bytes=0)  # Counters of processes that have gone
+        self.process_count = 0
+        self.usage = None    # children_usage() at start
+        self.peak_rss = 0
+        self.current = dict(cpu_seconds=0.0, rss=0, read_bytes=0, write_bytes=0)
+
+        self.lock = Lock()
+        self.done = Event()
+        self.thread = None
+
+    @property
+    def enabled(self):
+        return self.interval > 0 and PROC.is_dir()
+
+    def start(self, pid):
+        if not self.enabled:
+            return
+
+        self.pid = pid
+        self.started = time.monotonic()
+        self.usage = children_usage()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+
+        self.done.set()
+        self.thread.join()
+        self.thread = None
+        self.sample()
+        self.stopped = time.monotonic()
+
+        usage = children_usage()
+        if usage is None or self.usage is None:
+            return
+
+        with self.lock:
+            cpu = usage['cpu'] - self.usage['cpu']
+            self.current['cpu_seconds'] = round(max(self.current['cpu_seconds'], cpu), 2)
+            # The maximum is over all children of this process: it only belongs to the job if it has grown
+            if usage['maxrss'] > self.usage['maxrss']:
+                self.peak_rss = max(self.peak_rss, usage['maxrss'])
+
+    def run(self):
+        while True:
+            self.sample()
+            if self.done.wait(self.interval):
+                break
+
+    def sample(self):
+        try:
+            tree = process_tree(self.pid)
+        except OSError:
+            return
+
+        rss = 0
+        with self.lock:
+            alive = set()
+            for pid, stat in tree.items():
+                key = (pid, stat['start'])
+                if key not in self.processes:
+                    self.process_count += 1
+                alive.add(key)
+                rss += stat['rss']
+                self.processes[key] = dict(cpu=stat['cpu'], **read_proc_io(pid))
+
+            # Exited processes are folded into totals with their last seen counters
+            for key in [k for k in self.processes if k not in alive]:
+                counters = self.processes.pop(key)
+                for name in self.exited:
+                    self.exited[name] += counters[name]
+
+            def total(name):
+                return self.exited[name] + sum(p[name] for p in self.processes.values())
+
+            self.current = dict(
+                cpu_seconds = round(max(total('cpu'), self.current['cpu_seconds']), 2),
+                rss         = rss,
+                read_bytes  = total('read_bytes'),
+                write_bytes = total('write_bytes'),
+                )
+            self.peak_rss = max(self.peak_rss, rss)
+
+            if self.samples % self.stride == 0:
+                c = self.current
+                self.series.append([round(time.monotonic() - self.started, 1),
+                    c['cpu_seconds'], c['rss'], c['read_bytes'], c['write_bytes']])
+
+                if len(self.series) > self.max_points:
+                    self.series = self.series[::2]
+                    self.stride *= 2
+
+            self.samples += 1
+
+    def summary(self):
+        if self.started is None:
+            return None
+
+        with self.lock:
+            return dict(
+                self.current,
+                peak_rss  = self.peak_rss,
+                processes = self.process_count,
+                duration  = round((self.stopped or time.monotonic()) - self.started, 1),
+                )
+
+    def write(self, path):
+        if self.started is None:
+            return
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        summary = self.summary()
+        with self.lock:
+            data = dict(
+                summary  = summary,
+                interval = self.interval * self.stride,
+                columns  = ['seconds', 'cpu_seconds', 'rss', 'read_bytes', 'write_bytes'],
+                series   = self.series,
+                )
+        path.write_text(json.dumps(data), encoding='utf-8')
@@ -0,0 +1,89 @@
+import copy
+import time
+from threading import Event, Lock
+
+#---------------------------------------------------------------------------
+class _Call:
+    def __init__(self, generation):
+        self.generation = generation
+        self.done = Event()
+        self.value = None
+        self.error = None
+
+#---------------------------------------------------------------------------
+class ResponseCache:
+    """
+    Read-through cache of API responses with a time to live per endpoint.
+
+    ttl maps an endpoint name to seconds. Endpoints that are not in ttl are
+    not cached. Concurrent calls with the same key share one request; with
+    a TTL of 0 calls are only coalesced, the response is not kept.
+    Callers get deep copies, so they may modify the returned values.
+    """
+    def __init__(self, ttl, clock=time.monotonic):
+        self.ttl = dict(ttl)
+        self.clock = clock
+        self.items = {}       # (endpoint, *args) -> (expires, value)
+        self.inflight = {}    # (endpoint, *args) -> _Call
+        self.generation = 0   # Incremented by invalidate: older responses are not stored
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.lock = Lock()
+
+    def get(self, endpoint, args, load):
+        ttl = self.ttl.get(endpoint)
+        if ttl is None:
+            return load()
+
+        key = (endpoint, *args)
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None and item[0] > self.clock():
+                self.hits += 1
+                return copy.deepcopy(item[1])
+
+            call = self.inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self.inflight[key] = _Call(self.generation)
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.value)
+
+        try:
+            call.value = load()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                if self.inflight.get(key) is call:
+                    del self.inflight[key]
+                if call.error is None and ttl > 0 and call.generation == self.generation:
+                    self.items[key] = (self.clock() + ttl, call.value)
+            call.done.set()
+
+        return copy.deepcopy(call.value)
+
+    def invalidate(self, *endpoints):
+        """
+        Drop cached responses of the endpoints (all if none are given).
+        Requests already in flight are not shared with later calls.
+        """
+        with self.lock:
+            self.generation += 1
+            for table in (self.items, self.inflight):
+                for key in list(table):
+                    if not endpoints or key[0] in endpoints:
+                        del table[key]
+
+    def stats(self):
+        with self.lock:
+            return dict(items=len(self.items), hits=self.hits, misses=self.misses, coalesced=self.coalesced)
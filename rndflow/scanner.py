@@ -0,0 +1,151 @@
+import os
+import re
+from pathlib import Path
+from typing import NamedTuple
+
+from .errors import JobLimitError
+
+DEFAULT_EXCLUDE = ('/in/', '/__pycache__/', '/.ipynb_checkpoints/')  # Top-level directories only
+
+#---------------------------------------------------------------------------
+def glob_regex(pattern):
+    """
+    Translate a glob to a regular expression. '*' and '?' do not match '/', '**' does.
+    """
+    i, n = 0, len(pattern)
+    regex = ''
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+            continue
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[':
+            j = pattern.find(']', i + 1)
+            if j < 0:
+                regex += re.escape(c)
+            else:
+                body = pattern[i + 1:j].replace('\\', '\\\\')
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                regex += f'[{body}]'
+                i = j
+        else:
+            regex += re.escape(c)
+        i += 1
+    return regex
+
+#---------------------------------------------------------------------------
+class ScanRules:
+    """
+    Exclude rules with .gitignore-like syntax:
+
+        name       excludes files and directories with this name at any depth
+        dir/name   patterns with a slash are relative to the job root ('/name' too)
+        name/      matches directories only
+        **         matches any number of directories
+        !pattern   re-includes what an earlier rule excluded
+
+    The last matching rule wins. Files inside an excluded directory can not be
+    re-included: excluded directories are not scanned at all.
+    """
+    def __init__(self, patterns=()):
+        self.rules = []
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern):
+        pattern = pattern.strip()
+        if not pattern or pattern.startswith('#'):
+            return
+
+        include = pattern.startswith('!')
+        if include:
+            pattern = pattern[1:]
+
+        dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+
+        if '/' in pattern:
+            regex = glob_regex(pattern.lstrip('/'))
+        else:
+            regex = '(?:.*/)?' + glob_regex(pattern)
+
+        self.rules.append((include, dir_only, re.compile(regex + r'\Z')))
+
+    def add_file(self, path):
+        path = Path(path)
+        if path.is_file():
+            for line in path.read_text(encoding='utf-8').splitlines():
+                self.add(line)
+
+    def excluded(self, name, is_dir):
+        result = False
+        for include, dir_only, regex in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(name):
+                result = not include
+        return result
+
+#---------------------------------------------------------------------------
+class ScannedFile(NamedTuple):
+    path: Path
+    name: str             # Path relative to the scan root, with '/' separators
+    stat: os.stat_result
+
+#---------------------------------------------------------------------------
+def scan_files(root, rules=None, skip=(), max_files=None, max_bytes=None, subdir=None):
+    """
+    List files under root (or only under its subdir) with os.scandir, keeping their stat results.
+
+    Excluded directories are not descended into, symbolic links to directories
+    are not followed. Raises JobLimitError as soon as the number or the total
+    size of the files goes over max_files or max_bytes.
+    """
+    rules = rules or ScanRules()
+    skip = {Path(p) for p in skip}
+
+    files = []
+    total = 0
+    if subdir:
+        subdir = subdir.strip('/')
+        if not (Path(root) / subdir).is_dir():
+            return files
+        stack = [(Path(root) / subdir, subdir + '/')]
+    else:
+        stack = [(Path(root), '')]
+
+    while stack:
+        directory, prefix = stack.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                name = prefix + entry.name
+                path = directory / entry.name
+
+                if entry.is_dir():
+                    if not entry.is_symlink() and not rules.excluded(name, True):
+                        stack.append((path, name + '/'))
+                    continue
+
+                if not entry.is_file() or path in skip or rules.excluded(name, False):
+                    continue
+
+                stat = entry.stat()
+                files.append(ScannedFile(path, name, stat))
+                total += stat.st_size
+
+                if max_files is not None and len(files) > max_files:
+                    raise JobLimitError(f'Too many output files: more than {max_files} (upload_max_files)')
+                if max_bytes is not None and total > max_bytes:
+                    raise JobLimitError(f'Output files are too large: more than {max_bytes} bytes (upload_max_bytes)')
+
+    return files
@@ -0,0 +1,108 @@
+import datetime
+import json
+import math
+from pathlib import Path
+
+import numpy
+
+try:
+    import orjson
+except ImportError: # Optional: the standard json module is used without it
+    orjson = None
+
+#---------------------------------------------------------------------------
+def _default(o):
+    if isinstance(o, numpy.generic):
+        return o.item()
+    if isinstance(o, numpy.ndarray):
+        return o.tolist()
+    if isinstance(o, (datetime.datetime, datetime.date, datetime.time)):
+        return o.isoformat()
+    raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+
+#---------------------------------------------------------------------------
+class NumpyEncoder(json.JSONEncoder):
+    def default(self, o):
+        try:
+            return _default(o)
+        except TypeError:
+            return super().default(o)
+
+#---------------------------------------------------------------------------
+def json_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, cls=NumpyEncoder).encode('utf-8')
+
+def json_loads(data):
+    return json.loads(data)
+
+#---------------------------------------------------------------------------
+def finite(obj):
+    """
+    False if obj holds NaN or infinity, which orjson would silently write as null.
+    """
+    if isinstance(obj, float):
+        return math.isfinite(obj)
+    if isinstance(obj, dict):
+        return all(finite(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return all(finite(v) for v in obj)
+    if isinstance(obj, numpy.ndarray):
+        return obj.dtype.kind not in 'fc' or bool(numpy.isfinite(obj).all())
+    if isinstance(obj, numpy.inexact):
+        return bool(numpy.isfinite(obj))
+    return True
+
+#---------------------------------------------------------------------------
+if orjson is not None:
+    ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def orjson_dumps(obj):
+        try:
+            data = orjson.dumps(obj, default=_default, option=ORJSON_OPTIONS)
+        except TypeError:
+            # Integers over 64 bits and other values orjson does not support
+            return json_dumps(obj)
+
+        # orjson writes NaN and infinity as null: only then is the object walked
+        if b'null' in data and not finite(obj):
+            return json_dumps(obj) # Keeps NaN and Infinity as the json module always wrote them
+        return data
+
+    def orjson_loads(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # NaN and Infinity written by the json module (and earlier rndflow versions)
+            return json_loads(data)
+
+    _dumps, _loads = orjson_dumps, orjson_loads
+else:
+    _dumps, _loads = json_dumps, json_loads
+
+#---------------------------------------------------------------------------
+def set_json_backend(dumps_fn, loads_fn):
+    """
+    Replace the functions used to encode and decode package fields and job
+    metadata. dumps_fn(obj) must return UTF-8 encoded bytes, loads_fn(data)
+    must accept bytes or str. Default: orjson if installed, else the json module.
+    """
+    global _dumps, _loads # pylint: disable=global-statement
+    _dumps, _loads = dumps_fn, loads_fn
+
+#---------------------------------------------------------------------------
+def dumps(obj):
+    """
+    Encode to UTF-8 JSON bytes. numpy arrays and scalars, dates and times are
+    supported. NaN and infinity are written as NaN and Infinity, like the json module does.
+    """
+    return _dumps(obj)
+
+def loads(data):
+    return _loads(data)
+
+#---------------------------------------------------------------------------
+def read_json(path):
+    return _loads(Path(path).read_bytes())
+
+def write_json(path, obj):
+    Path(path).write_bytes(_dumps(obj))
@@ -1,19 +1,28 @@
 import os
+import base64
 import functools
 import hashlib
+import json
 import mimetypes
-from time import sleep
+from threading import RLock
+from time import sleep, time
 from datetime import datetime, timedelta
 import pathlib
+import socket
 import requests
 
 from binaryornot.check import is_binary
 from requests.adapters import HTTPAdapter
 from urllib3.util import Retry
+from urllib3.connection import HTTPConnection
 from urllib3.exceptions import ProtocolError
 
-from .config import Settings
+from .config import Settings, settings
 from .logger import logger
+from .object_cache import ObjectCache
+from .response_cache import ResponseCache
+from .serializer import loads
+from .tracing import POOL_CLASSES, TracedSession, JsonlExporter, endpoint_template, finish_span
 
 ##import ssl
 #urllib3.disable_warnings()
@@ -25,6 +34,12 @@ class PossibleNetworkError(Exception):
         self.message = message
         super().__init__(self.message)
 
+#---------------------------------------------------------------------------------------
+class DownloadCancelled(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
 #---------------------------------------------------------------------------
 def response_json(fn):
     @functools.wraps(fn)
@@ -36,7 +51,7 @@ def response_json(fn):
                 if r.status_code != requests.codes.ok: # pylint: disable=no-member
                     print(*args[1:], r.text)
                 r.raise_for_status()
-                return r.json()
+                return loads(r.content)
             except (ConnectionResetError, ProtocolError, ConnectionError) as exc:
                 logger.error('Error [%s] in [%s]:', str(exc), fn.__name__)
                 sleep(2.0)
@@ -45,6 +60,11 @@ def response_json(fn):
                     raise exc from exc
     return wrapper
 
+#---------------------------------------------------------------------------
+def response_retries(response):
+    retries = getattr(response.raw, 'retries', None)
+    return len(retries.history) if retries is not None else 0
+
 #---------------------------------------------------------------------------
 def file_hash(path):
     chunk = 65536
@@ -56,14 +76,89 @@ def file_hash(path):
 
     return h.hexdigest()
 
+#---------------------------------------------------------------------------
+def token_expiry(token):
+    """
+    Expiration time (unix timestamp) from the 'exp' claim of a JWT token.
+    None if the token is not a JWT or has no expiration.
+    """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except Exception:
+        return None
+
+#---------------------------------------------------------------------------
+class TokenAuth(requests.auth.AuthBase):
+    """
+    Sets the current access token on every request, refreshing it first if it is about to expire.
+    """
+    def __init__(self, server):
+        self.server = server
+
+    def __call__(self, request):
+        self.server.refresh_if_expiring()
+        request.headers.update(self.server.access_header)
+        return request
+
+#---------------------------------------------------------------------------
+def tcp_keepalive_options(cfg):
+    options = list(HTTPConnection.default_socket_options)
+
+    if not cfg.conn_tcp_keepalive:
+        return options
+
+    options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    for name, value in (('TCP_KEEPIDLE',  cfg.conn_tcp_keepalive_idle),
+                        ('TCP_KEEPINTVL', cfg.conn_tcp_keepalive_interval),
+                        ('TCP_KEEPCNT',   cfg.conn_tcp_keepalive_count)):
+        if hasattr(socket, name): # Not available on every platform
+            options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+
+    return options
+
+#---------------------------------------------------------------------------
+def idle_connections(pool):
+    if pool.pool is None:
+        return 0
+    # The queue is pre-filled with None placeholders: count only real connections
+    with pool.pool.mutex:
+        return sum(c is not None for c in pool.pool.queue)
+
 #---------------------------------------------------------------------------
 class TimeoutHTTPAdapter(HTTPAdapter):
-    def __init__(self, timeout, ssl_verify, *args, **kwargs):
+    def __init__(self, timeout, ssl_verify, *args, socket_options=None, **kwargs):
         self.ssl_verify = ssl_verify
         self.timeout = timeout
+        self.socket_options = socket_options
 
         super().__init__(*args, **kwargs)
 
+    def init_poolmanager(self, *args, **kwargs):
+        if self.socket_options is not None:
+            kwargs['socket_options'] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = POOL_CLASSES
+
+    def pool_stats(self):
+        stats = []
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats.append(dict(
+                scheme      = key.key_scheme,
+                host        = key.key_host,
+                port        = key.key_port,
+                connections = pool.num_connections, # Connections opened (TLS handshakes) so far
+                requests    = pool.num_requests,
+                idle        = idle_connections(pool),
+                maxsize     = pool.pool.maxsize if pool.pool is not None else 0,
+                ))
+        return stats
+
     def send(self, request, stream=False, timeout=None, verify=None, cert=None, proxies=None, **kwargs):
         if timeout is None:
             timeout = self.timeout
@@ -74,9 +169,10 @@ class TimeoutHTTPAdapter(HTTPAdapter):
 
 #---------------------------------------------------------------------------
 class Server:
-    def __init__(self, api_server=None, api_key=None):
+    def __init__(self, api_server=None, api_key=None, cfg: Settings=None):
 
-        cfg = Settings()
+        cfg = cfg or settings()
+        self.cfg = cfg
 
         if cfg.api_server_direct is not None:
             api_server = cfg.api_server_direct
@@ -92,54 +188,48 @@ class Server:
         else:
             raise Exception('No API server specified')
 
-        # https://findwork.dev/blog/advanced-usage-python-requests-timeouts-retries-hooks
-        # https://www.peterbe.com/plog/best-practice-with-retries-with-requests
-        adapter = TimeoutHTTPAdapter(timeout=(cfg.common_conn_timeout, cfg.common_conn_read_timeout),
-            ssl_verify=cfg.ssl_verify,
-            max_retries=Retry(
-                total=cfg.common_conn_retry_total,
-                read=cfg.common_conn_retry_read,
-                connect=cfg.common_conn_retry_connect,
-                redirect=cfg.common_conn_retry_redirect,
-                status=cfg.common_conn_retry_status,
-                other=cfg.common_conn_retry_other,
-                backoff_factor=cfg.common_conn_retry_backoff_factor,
-                status_forcelist=(502,504))
-            )
-
-        adapter_spec = TimeoutHTTPAdapter(timeout=(cfg.spec_conn_timeout, cfg.spec_conn_read_timeout),
-            ssl_verify=cfg.ssl_verify,
-            max_retries=Retry(
-                total=cfg.spec_conn_retry_total,
-                read=cfg.spec_conn_retry_read,
-                connect=cfg.spec_conn_retry_connect,
-                redirect=cfg.spec_conn_retry_redirect,
-                status=cfg.spec_conn_retry_status,
-                other=cfg.spec_conn_retry_other,
-                backoff_factor=cfg.spec_conn_retry_backoff_factor,
-                status_forcelist=(502,504))
+        self.object_cache = None
+        if cfg.object_cache_dir:
+            self.object_cache = ObjectCache(cfg.object_cache_dir, cfg.object_cache_max_bytes)
+
+        self.request_hooks = []
+        if cfg.trace_file:
+            self.add_request_hook(JsonlExporter(cfg.trace_file))
+
+        self.session = TracedSession('common', self.emit_span)
+        self.raw_session = TracedSession('raw', self.emit_span)
+        self.spec_session = TracedSession('spec', self.emit_span)
+        self.heartbeat_session = TracedSession('heartbeat', self.emit_span)
+
+        # Every session has its own adapter (and so its own connection pools):
+        # object storage transfers must not starve API calls and vice versa.
+        self.adapters = dict(
+            common = self.make_adapter(cfg, 'common'),
+            raw    = self.make_adapter(cfg, 'common', 'raw'),
+            spec   = self.make_adapter(cfg, 'spec'),
+            heartbeat = self.make_adapter(cfg, 'heartbeat'),
             )
 
-        self.session = requests.Session()
-        self.raw_session = requests.Session()
-        self.spec_session = requests.Session()
-
-        for session in (self.session, self.raw_session):
-            session.mount('http://', adapter)
-            session.mount('https://', adapter)
+        for role, session in (('common', self.session), ('raw', self.raw_session), ('spec', self.spec_session),
+                ('heartbeat', self.heartbeat_session)):
+            session.mount('http://', self.adapters[role])
+            session.mount('https://', self.adapters[role])
             session.verify = False
-
-        self.spec_session.mount('http://', adapter_spec)
-        self.spec_session.mount('https://', adapter_spec)
-        self.spec_session.verify = False
+            if not cfg.conn_keep_alive:
+                session.headers['Connection'] = 'close'
 
         self.access_token = None
+        self.access_token_expires = None
+        self.access_token_refresh_at = None
         self.refresh_token = None
+        self.token_lock = RLock()
+
+        self.session.auth = TokenAuth(self)
+        self.spec_session.auth = TokenAuth(self)
+        self.heartbeat_session.auth = TokenAuth(self)
 
         if api_key is not None:
             self.access_token = api_key
-            self.session.headers.update(self.access_header)
-            self.spec_session.headers.update(self.access_header)
         else:
             self.refresh_token = cfg.refresh_token
             self.refresh_url = f'{self.base_url}/executor_api/auth/refresh'
@@ -147,6 +237,73 @@ class Server:
 
         self.session.hooks['response'].append(self.refresh_as_needed)
         self.spec_session.hooks['response'].append(self.refresh_as_needed_spec)
+        self.heartbeat_session.hooks['response'].append(self.refresh_as_needed_heartbeat)
+
+    @staticmethod
+    def make_adapter(cfg, prefix, pool_prefix=None):
+        pool_prefix = pool_prefix or prefix
+
+        def option(name):
+            return getattr(cfg, f'{prefix}_conn_{name}')
+
+        def pool_option(name):
+            return getattr(cfg, f'{pool_prefix}_conn_pool_{name}')
+
+        # https://findwork.dev/blog/advanced-usage-python-requests-timeouts-retries-hooks
+        # https://www.peterbe.com/plog/best-practice-with-retries-with-requests
+        return TimeoutHTTPAdapter(timeout=(option('timeout'), option('read_timeout')),
+            ssl_verify=cfg.ssl_verify,
+            socket_options=tcp_keepalive_options(cfg),
+            pool_connections=pool_option('connections'),
+            pool_maxsize=pool_option('maxsize'),
+            pool_block=pool_option('block'),
+            max_retries=Retry(
+                total=option('retry_total'),
+                read=option('retry_read'),
+                connect=option('retry_connect'),
+                redirect=option('retry_redirect'),
+                status=option('retry_status'),
+                other=option('retry_other'),
+                backoff_factor=option('retry_backoff_factor'),
+                status_forcelist=(502,504))
+            )
+
+    def add_request_hook(self, hook):
+        """
+        Call hook(span) after every HTTP request. A span is a dict with:
+
+            role            session: common, spec, raw (object storage) or heartbeat
+            method, endpoint, status, error
+            started_at      unix time
+            connect         seconds spent opening connections (TCP and TLS handshakes)
+            ttfb            seconds until the response headers arrived
+            total           seconds until the response body was read
+            retries         urllib3 retries of the request
+            bytes_sent, bytes_received
+
+        See rndflow.tracing.JsonlExporter and HistogramExporter for ready-made hooks.
+        """
+        self.request_hooks.append(hook)
+
+    def remove_request_hook(self, hook):
+        self.request_hooks.remove(hook)
+
+    def emit_span(self, span):
+        if not self.request_hooks:
+            return
+
+        span['endpoint'] = endpoint_template(span.pop('url'), self.base_url)
+        for hook in self.request_hooks:
+            try:
+                hook(span)
+            except Exception as e:
+                logger.error('Request hook error: %s', e)
+
+    def pool_stats(self):
+        """
+        Connection pool usage per session role, for monitoring.
+        """
+        return {role: adapter.pool_stats() for role, adapter in self.adapters.items()}
 
     @property
     def access_header(self):
@@ -156,37 +313,72 @@ class Server:
     def refresh_header(self):
         return dict(Authorization=f'Bearer {self.refresh_token}')
 
-    def refresh_tokens(self):
-        r = self.raw_session.post(self.refresh_url,
-                headers=self.refresh_header)
-        if r.status_code != requests.codes.ok: # pylint: disable=no-member
-            print(self.refresh_url, r.text)
-        r.raise_for_status()
-        data = r.json()
+    def refresh_tokens(self, stale_token=None, expiring=False):
+        """
+        Exchange the refresh token for a new token pair.
+
+        Only one thread refreshes at a time. When stale_token is given and the
+        current access token differs from it, another thread has already done
+        the refresh and nothing is sent: the refresh token is rotated by the
+        server, so a second concurrent refresh would invalidate the first one.
+        With expiring, nothing is sent unless the current token is (still) due
+        for the proactive refresh.
+        """
+        with self.token_lock:
+            if stale_token is not None and stale_token != self.access_token:
+                return
+            if expiring and (self.access_token_refresh_at is None or time() <= self.access_token_refresh_at):
+                return
+
+            r = self.raw_session.post(self.refresh_url,
+                    headers=self.refresh_header)
+            if r.status_code != requests.codes.ok: # pylint: disable=no-member
+                print(self.refresh_url, r.text)
+            r.raise_for_status()
+            data = r.json()
+
+            self.access_token = data['access_token']
+            self.refresh_token = data['refresh_token']
+
+            now = time()
+            if data.get('expires_in') is not None:
+                self.access_token_expires = now + float(data['expires_in'])
+            else:
+                self.access_token_expires = token_expiry(self.access_token)
 
-        self.access_token = data['access_token']
-        self.refresh_token = data['refresh_token']
+            self.access_token_refresh_at = None
+            if self.access_token_expires is not None:
+                # A token living less than the margin would otherwise be refreshed before every request
+                lifetime = self.access_token_expires - now
+                self.access_token_refresh_at = self.access_token_expires - min(self.cfg.token_refresh_margin, lifetime / 2)
 
-        self.session.headers.update(self.access_header)
-        self.spec_session.headers.update(self.access_header)
+    def refresh_if_expiring(self):
+        refresh_at = self.access_token_refresh_at
+        if self.refresh_token and refresh_at is not None and time() > refresh_at:
+            # Read without the lock: refresh_tokens checks again under it
+            self.refresh_tokens(stale_token=self.access_token, expiring=True)
 
-    def refresh_as_needed(self, response, *args, **kwargs):
+    def resend_unauthorized(self, session, response, *args, **kwargs):
         if response.status_code == requests.codes.unauthorized and self.refresh_token: # pylint: disable=no-member
-            self.refresh_tokens()
-
             request = response.request
+            stale_token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+
+            self.refresh_tokens(stale_token=stale_token)
+
             request.headers.update(self.access_header)
 
-            return self.session.send(request, *args, **kwargs)
+            return session.send(request, *args, **kwargs)
 
-    def refresh_as_needed_spec(self, response, *args, **kwargs):
-        if response.status_code == requests.codes.unauthorized and self.refresh_token: # pylint: disable=no-member
-            self.refresh_tokens()
+        return None
 
-            request = response.request
-            request.headers.update(self.access_header)
+    def refresh_as_needed(self, response, *args, **kwargs):
+        return self.resend_unauthorized(self.session, response, *args, **kwargs)
+
+    def refresh_as_needed_spec(self, response, *args, **kwargs):
+        return self.resend_unauthorized(self.spec_session, response, *args, **kwargs)
 
-            return self.spec_session.send(request, *args, **kwargs)
+    def refresh_as_needed_heartbeat(self, response, *args, **kwargs):
+        return self.resend_unauthorized(self.heartbeat_session, response, *args, **kwargs)
 
     @response_json
     def get(self, resource, *args, **kwargs):
@@ -208,17 +400,39 @@ class Server:
     def spec_post(self, resource, *args, **kwargs):
         return self.spec_session.post(f'{self.base_url}{resource}', *args, **kwargs)
 
+    @response_json
+    def heartbeat_post(self, resource, *args, **kwargs):
+        return self.heartbeat_session.post(f'{self.base_url}{resource}', *args, **kwargs)
+
     @response_json
     def delete(self, resource, *args, **kwargs):
         return self.session.delete(f'{self.base_url}{resource}', *args, **kwargs)
 
-    def download(self, file, path=None, folder=None):
+    def download(self, file, path=None, folder=None, cancel=None):
+        """
+        Download the file and check its content hash. Setting the cancel
+        event aborts the transfer with DownloadCancelled.
+        """
         if folder is not None:
             path = pathlib.Path(folder) / file['name']
         path.parent.mkdir(parents=True, exist_ok=True)
 
         logger.info('Downloading %s ...', path)
 
+        stats = dict(bytes=0, retries=0, cached=False)
+
+        if self.object_cache is not None and self.object_cache.get(file['content_hash'], path):
+            logger.info('%s: taken from the object cache.', path)
+            stats['cached'] = True
+        else:
+            self.fetch(file, path, stats, cancel)
+
+        if file['is_executable']:
+            os.chmod(path, 0o770)
+
+        return stats
+
+    def fetch(self, file, path, stats, cancel=None):
         ntries = 2
 
         while True:
@@ -228,12 +442,19 @@ class Server:
             except Exception as e:
                raise PossibleNetworkError(f"Could not download file {file['name']}: {str(e)}") from None
 
+            stats['retries'] += response_retries(r)
+
             h = hashlib.sha256()
             with open(path, 'wb') as f:
                 for chunk in r:
+                    if cancel is not None and cancel.is_set():
+                        r.close()
+                        raise DownloadCancelled(f"Download of {file['name']} cancelled")
                     h.update(chunk)
                     f.write(chunk)
+                    stats['bytes'] += len(chunk)
 
+            finish_span(r, stats['bytes'])
             ntries -= 1
 
             if h.hexdigest() == file['content_hash']:
@@ -241,11 +462,15 @@ class Server:
 
             if ntries > 0:
                 logger.info('%s: wrong content checksum. retrying...', path)
+                stats['retries'] += 1
             else:
                 raise PossibleNetworkError(f'{path}: wrong content checksum.')
 
-        if file['is_executable']:
-            os.chmod(path, 0o770)
+        if self.object_cache is not None:
+            try:
+                self.object_cache.put(file['content_hash'], path)
+            except OSError as e:
+                logger.warning('Could not add %s to the object cache: %s', path, e)
 
     def upload_project_file(self, project, path, name=None):
         path     = pathlib.Path(path)
@@ -279,7 +504,8 @@ class ServerProxy (Server):
     """
     Wrapper for Server class
     """
-    def __init__(self, api_key:str, project:int, input_node:int, output_node:int, api_server:str=None):
+    def __init__(self, api_key:str, project:int, input_node:int, output_node:int, api_server:str=None,
+            cache_ttl:dict=None):
         """
         Args:
             api_key (str): API key
@@ -287,15 +513,20 @@ class ServerProxy (Server):
             input_node (int): Input node ID of project-server
             output_node (int): Output node ID of project-server
             api_server (str, optional): API server URL. Defaults to None.
+            cache_ttl (dict, optional): Seconds to cache responses of 'last_datalayer', 'data_layers'
+                and 'files_list' calls, e.g. dict(last_datalayer=5, files_list=60). Identical
+                concurrent calls of these endpoints share one request, 0 enables only that.
+                Defaults to None: no caching.
         """
         self.project = project
         self.input_node = input_node
         self.output_node = output_node
+        self.cache = ResponseCache(cache_ttl or {})
 
         super().__init__(api_key=api_key, api_server=api_server)
 
     @classmethod
-    def get_server(cls, prefix: str, api_server:str=None):
+    def get_server(cls, prefix: str, api_server:str=None, cache_ttl:dict=None):
         """
         Get ServerProxy object.
 
@@ -303,6 +534,7 @@ class ServerProxy (Server):
             cls (ServerProxy): ServerProxy class
             prefix (str): API key secrets common prefix name
             api_server (str,optional): API server URL. Defaults to None.
+            cache_ttl (dict, optional): Response cache TTLs, see ServerProxy. Defaults to None.
 
         Returns:
              ServerProxy object
@@ -318,7 +550,16 @@ class ServerProxy (Server):
         input_node = secret(f'{prefix}_input')
         output_node = secret(f'{prefix}_output')
 
-        return ServerProxy(api_key, project, input_node, output_node, api_server)
+        return ServerProxy(api_key, project, input_node, output_node, api_server, cache_ttl)
+
+    def invalidate_cache(self, *endpoints):
+        """
+        Drop cached responses.
+
+        Args:
+            endpoints (str): 'last_datalayer', 'data_layers', 'files_list'. All if none are given.
+        """
+        self.cache.invalidate(*endpoints)
 
     def get_last_datalayer(self)->int:
         """
@@ -326,7 +567,8 @@ class ServerProxy (Server):
         Returns:
             int: data layer ID
         """
-        layer = self.get(f'/projects/{self.project}/data_layers/last')
+        layer = self.cache.get('last_datalayer', (),
+                lambda: self.get(f'/projects/{self.project}/data_layers/last'))
         return layer['id']
 
     def get_data_layers(self)->list:
@@ -335,7 +577,8 @@ class ServerProxy (Server):
         Returns:
             list of dict: list of data layers ID
         """
-        rez = self.get(f'/projects/{self.project}/data_layers')
+        rez = self.cache.get('data_layers', (),
+                lambda: self.get(f'/projects/{self.project}/data_layers'))
         layers = list(map(lambda x: x['id'], rez))
         return layers
 
@@ -458,7 +701,8 @@ class ServerProxy (Server):
         Returns:
             list: files list
         """
-        return self.get(f'/projects/{self.project}/nodes/{self.output_node}/packages/{ident}/files')
+        return self.cache.get('files_list', (ident,),
+                lambda: self.get(f'/projects/{self.project}/nodes/{self.output_node}/packages/{ident}/files'))
 
     def wait_one_result_and_files(self, layer, master, timeout=timedelta(minutes=5), retry_pause:int=5)->list:
         """
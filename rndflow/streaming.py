@@ -0,0 +1,82 @@
+import time
+from threading import Event, Thread
+
+from .resources import PROC, open_files
+from .scanner import scan_files
+
+#---------------------------------------------------------------------------
+class OutputStreamer:
+    """
+    Uploads finished output files while the job script is still running.
+
+    Every `interval` seconds the `subdir` of the job directory is scanned.
+    A file is passed to upload(entries) once its size and modification time
+    have not changed for `stable` seconds and no process of the job has it open.
+    A file that changes after it was streamed is picked up again; whatever is
+    left is handled by the final Job.upload.
+    """
+    def __init__(self, root, upload, rules, logger, interval=10, stable=30, subdir='out'):
+        self.root = root
+        self.upload = upload
+        self.rules = rules
+        self.logger = logger
+        self.interval = interval
+        self.stable = stable
+        self.subdir = subdir
+
+        self.pid = None
+        self.seen = {}      # path -> ((size, mtime), first seen with this state)
+        self.streamed = {}  # path -> (size, mtime) when uploaded
+
+        self.done = Event()
+        self.thread = None
+
+    def start(self, pid=None):
+        self.pid = pid
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+
+        self.done.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:
+                self.logger.error('Output streaming error: %s', e)
+
+    def ready(self):
+        now = time.monotonic()
+        entries = []
+        for entry in scan_files(self.root, self.rules, subdir=self.subdir):
+            state = (entry.stat.st_size, entry.stat.st_mtime_ns)
+            if self.streamed.get(entry.path) == state:
+                continue
+
+            seen = self.seen.get(entry.path)
+            if seen is None or seen[0] != state:
+                self.seen[entry.path] = (state, now)
+            elif now - seen[1] >= self.stable:
+                entries.append(entry)
+
+        if entries and self.pid is not None and PROC.is_dir():
+            busy = open_files(self.pid)
+            entries = [e for e in entries if str(e.path) not in busy]
+
+        return entries
+
+    def poll(self):
+        entries = self.ready()
+        if not entries:
+            return
+
+        self.upload(entries)
+
+        for entry in entries:
+            self.streamed[entry.path] = (entry.stat.st_size, entry.stat.st_mtime_ns)
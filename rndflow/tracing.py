@@ -0,0 +1,226 @@
+import json
+import math
+import re
+import time
+from pathlib import Path
+from threading import Lock, local
+from urllib.parse import urlsplit
+
+import requests
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+_timing = local()
+
+#---------------------------------------------------------------------------
+# Connections that remember how long connect() (TCP and TLS handshake) took
+# in the current thread, so that a request span can report it.
+class TimedConnectMixin:
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _timing.connect = getattr(_timing, 'connect', 0.0) + time.perf_counter() - start
+
+class TimedHTTPConnection(TimedConnectMixin, HTTPConnection):
+    pass
+
+class TimedHTTPSConnection(TimedConnectMixin, HTTPSConnection):
+    pass
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+POOL_CLASSES = dict(http=TimedHTTPConnectionPool, https=TimedHTTPSConnectionPool)
+
+#---------------------------------------------------------------------------
+_id_segment = re.compile(r'^\d+$')
+_hash_segment = re.compile(r'^[0-9a-fA-F]{32,}$')
+
+def endpoint_template(url, base_url=None):
+    """
+    Group URLs by endpoint: '/executor_api/jobs/12/files' -> '/executor_api/jobs/{id}/files'.
+    URLs outside of the API (presigned object storage links) are reduced to their host.
+    """
+    if not base_url or not url.startswith(base_url):
+        parts = urlsplit(url)
+        return f'{parts.scheme}://{parts.netloc}/{{object}}'
+
+    segments = []
+    for segment in urlsplit(url[len(base_url):]).path.split('/'):
+        if _id_segment.match(segment):
+            segment = '{id}'
+        elif _hash_segment.match(segment):
+            segment = '{hash}'
+        segments.append(segment)
+
+    return '/'.join(segments)
+
+#---------------------------------------------------------------------------
+def body_size(request):
+    body = request.body
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    return int(request.headers.get('Content-Length', 0))
+
+#---------------------------------------------------------------------------
+class TracedSession(requests.Session):
+    """
+    Session that reports a span for every request it sends:
+
+        role, method, url, status, error, started_at,
+        connect, ttfb, total (seconds), retries, bytes_sent, bytes_received
+
+    The span of a streamed response is emitted by finish_span() once the body is consumed.
+    Redirects and resent requests are included in the span of the original request.
+    """
+    def __init__(self, role, emit):
+        super().__init__()
+        self.role = role
+        self.emit = emit
+
+    def send(self, request, **kwargs):
+        sessions = getattr(_timing, 'sessions', None)
+        if sessions is None:
+            sessions = _timing.sessions = set()
+        if id(self) in sessions:
+            # A redirect or a request resent by a response hook (token refresh): part of the outer span
+            return super().send(request, **kwargs)
+
+        outer_connect = getattr(_timing, 'connect', 0.0)  # Of a span this request is nested in
+        _timing.connect = 0.0
+        sessions.add(id(self))
+
+        started_at = time.time()
+        start = time.perf_counter()
+
+        span = dict(role=self.role, method=request.method, url=request.url,
+                status=None, error=None, started_at=started_at,
+                bytes_sent=body_size(request), bytes_received=0)
+
+        try:
+            r = super().send(request, **kwargs)
+        except Exception as e:
+            span.update(connect=_timing.connect, total=time.perf_counter() - start, error=type(e).__name__)
+            self.emit(span)
+            raise
+        finally:
+            connect = _timing.connect
+            sessions.discard(id(self))
+            _timing.connect = outer_connect + connect
+
+        retries = getattr(r.raw, 'retries', None)
+        span.update(
+            status  = r.status_code,
+            connect = connect,
+            ttfb    = r.elapsed.total_seconds(),
+            retries = len(retries.history) if retries is not None else 0,
+            )
+
+        if kwargs.get('stream'):
+            r.trace_span = (span, start, self.emit)
+        else:
+            span.update(total=time.perf_counter() - start, bytes_received=len(r.content or b''))
+            self.emit(span)
+
+        return r
+
+#---------------------------------------------------------------------------
+def finish_span(response, bytes_received):
+    trace = getattr(response, 'trace_span', None)
+    if trace is None:
+        return
+    response.trace_span = None
+
+    span, start, emit = trace
+    span.update(total=time.perf_counter() - start, bytes_received=bytes_received)
+    emit(span)
+
+#---------------------------------------------------------------------------
+class JsonlExporter:
+    """
+    Appends spans to a JSON lines file.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = Lock()
+
+    def __call__(self, span):
+        line = json.dumps(span, default=str) + '\n'
+        with self.lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+#---------------------------------------------------------------------------
+class HistogramExporter:
+    """
+    In-memory latency histogram (total time) per (method, endpoint).
+    """
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+    def __init__(self):
+        self.stats = {}
+        self.lock = Lock()
+
+    def __call__(self, span):
+        key = (span['method'], span['endpoint'])
+        total = span.get('total') or 0.0
+        with self.lock:
+            s = self.stats.get(key)
+            if s is None:
+                s = self.stats[key] = dict(count=0, errors=0, retries=0, total=0.0, max=0.0,
+                        connect=0.0, ttfb=0.0, bytes_sent=0, bytes_received=0,
+                        histogram=[0] * len(self.buckets))
+            s['count'] += 1
+            s['errors'] += span['error'] is not None or (span['status'] or 0) >= 400
+            s['retries'] += span.get('retries') or 0
+            s['total'] += total
+            s['max'] = max(s['max'], total)
+            s['connect'] += span.get('connect') or 0.0
+            s['ttfb'] += span.get('ttfb') or 0.0
+            s['bytes_sent'] += span['bytes_sent']
+            s['bytes_received'] += span['bytes_received']
+            s['histogram'][next(i for i, b in enumerate(self.buckets) if total <= b)] += 1
+
+    def quantile(self, histogram, q):
+        rank = q * sum(histogram)
+        seen = 0
+        for bound, count in zip(self.buckets, histogram):
+            seen += count
+            if seen >= rank:
+                return bound
+        return math.inf
+
+    def summary(self):
+        """
+        Endpoints sorted by the total time spent in them. Quantiles are bucket upper bounds.
+        """
+        with self.lock:
+            stats = {k: dict(v) for k, v in self.stats.items()}
+
+        rows = []
+        for (method, endpoint), s in stats.items():
+            rows.append(dict(
+                method         = method,
+                endpoint       = endpoint,
+                count          = s['count'],
+                errors         = s['errors'],
+                retries        = s['retries'],
+                total          = s['total'],
+                mean           = s['total'] / s['count'],
+                mean_connect   = s['connect'] / s['count'],
+                mean_ttfb      = s['ttfb'] / s['count'],
+                p50            = self.quantile(s['histogram'], 0.5),
+                p95            = self.quantile(s['histogram'], 0.95),
+                max            = s['max'],
+                bytes_sent     = s['bytes_sent'],
+                bytes_received = s['bytes_received'],
+                ))
+
+        return sorted(rows, key=lambda r: r['total'], reverse=True)
@@ -0,0 +1,4 @@
+import os
+
+# rndflow reads its settings on import; the refresh token is the only required one
+os.environ.setdefault('RNDFLOW_REFRESH_TOKEN', 'test')
@@ -0,0 +1,65 @@
+import importlib
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+#---------------------------------------------------------------------------
+@pytest.fixture(name='job')
+def job_fixture(tmp_path, monkeypatch):
+    # rndflow.job takes the job id from the name of the working directory
+    workdir = tmp_path / '1'
+    workdir.mkdir()
+    monkeypatch.chdir(workdir)
+
+    module = importlib.import_module('rndflow.job')
+    monkeypatch.setattr(module, 'root', workdir)
+    monkeypatch.setattr(module, 'package_index', 0)
+    return module
+
+def allocated(job):
+    return sorted(int(p.name) for p in (job.root / 'out').iterdir())
+
+#---------------------------------------------------------------------------
+def test_allocate_sequential(job):
+    assert [job.allocate_package().name for _ in range(3)] == ['1', '2', '3']
+
+def test_allocate_skips_existing(job):
+    (job.root / 'out' / '1').mkdir(parents=True)
+    (job.root / 'out' / '5').mkdir()
+
+    assert job.allocate_package().name == '6'
+
+def test_allocate_threads(job):
+    with ThreadPoolExecutor(8) as executor:
+        paths = list(executor.map(lambda _: job.allocate_package(), range(100)))
+
+    assert len(set(paths)) == 100
+    assert allocated(job) == list(range(1, 101))
+
+def allocate_many(count):
+    job = importlib.import_module('rndflow.job')
+    return [job.allocate_package().name for _ in range(count)]
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason='needs fork')
+def test_allocate_processes(job):
+    with multiprocessing.get_context('fork').Pool(4) as pool:
+        names = [n for chunk in pool.map(allocate_many, [25] * 4) for n in chunk]
+
+    assert len(set(names)) == 100
+    assert allocated(job) == list(range(1, 101))
+
+def test_allocate_explicit_index(job):
+    assert job.allocate_package(index=7).name == '7'
+
+    with pytest.raises(FileExistsError):
+        job.allocate_package(index=7)
+
+def test_save_package_does_not_overwrite(job):
+    path = job.save_package(label='auto', fields=dict(a=1))
+
+    with pytest.raises(FileExistsError):
+        job.save_package(label='explicit', fields=dict(b=2), index=int(path.name))
+
+    assert (path / 'label').read_text() == 'auto'
+    assert job.read_json(path / 'fields.json') == dict(a=1)
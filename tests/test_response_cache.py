@@ -0,0 +1,143 @@
+import time
+from threading import Event, Thread
+
+import pytest
+
+from rndflow.response_cache import ResponseCache
+
+#---------------------------------------------------------------------------
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class Loader:
+    def __init__(self, release=None):
+        self.calls = 0
+        self.release = release
+
+    def __call__(self):
+        self.calls += 1
+        if self.release is not None:
+            self.release.wait(5)
+        return dict(id=self.calls, items=[1, 2])
+
+#---------------------------------------------------------------------------
+def test_ttl():
+    clock = Clock()
+    cache = ResponseCache(dict(layers=10), clock=clock)
+    load = Loader()
+
+    assert cache.get('layers', (), load)['id'] == 1
+    clock.now = 9
+    assert cache.get('layers', (), load)['id'] == 1
+    clock.now = 11
+    assert cache.get('layers', (), load)['id'] == 2
+    assert cache.stats() == dict(items=1, hits=1, misses=2, coalesced=0)
+
+def test_keys_and_uncached_endpoints():
+    cache = ResponseCache(dict(files=10))
+    load = Loader()
+
+    cache.get('files', (1,), load)
+    cache.get('files', (2,), load)
+    cache.get('files', (1,), load)
+    assert load.calls == 2
+
+    cache.get('other', (), load)
+    cache.get('other', (), load)
+    assert load.calls == 4
+
+def test_copies():
+    cache = ResponseCache(dict(layers=10))
+    cache.get('layers', (), Loader())['items'].append(3)
+    assert cache.get('layers', (), Loader())['items'] == [1, 2]
+
+#---------------------------------------------------------------------------
+def run_concurrently(n, fn):
+    results = [None] * n
+    def target(i):
+        results[i] = fn()
+    threads = [Thread(target=target, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    return threads, results
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+@pytest.mark.parametrize('ttl', [0, 10])
+def test_coalescing(ttl):
+    release = Event()
+    cache = ResponseCache(dict(layers=ttl))
+    load = Loader(release)
+
+    threads, results = run_concurrently(8, lambda: cache.get('layers', (), load))
+    wait_for(lambda: cache.stats()['coalesced'] == 7)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert load.calls == 1
+    assert all(r['id'] == 1 for r in results)
+    assert cache.stats()['items'] == (1 if ttl else 0)
+
+def test_errors_are_shared_and_not_cached():
+    release = Event()
+    cache = ResponseCache(dict(layers=10))
+
+    def fail():
+        release.wait(5)
+        raise ValueError('server error')
+
+    errors = []
+    def call():
+        try:
+            cache.get('layers', (), fail)
+        except ValueError as e:
+            errors.append(e)
+
+    threads, _ = run_concurrently(4, call)
+    wait_for(lambda: cache.stats()['coalesced'] == 3)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert len(errors) == 4
+    assert cache.get('layers', (), Loader())['id'] == 1
+
+#---------------------------------------------------------------------------
+def test_invalidate():
+    cache = ResponseCache(dict(layers=10, files=10))
+    load = Loader()
+
+    cache.get('layers', (), load)
+    cache.get('files', (1,), load)
+    cache.invalidate('layers')
+    assert cache.stats()['items'] == 1
+
+    cache.invalidate()
+    assert cache.stats()['items'] == 0
+
+def test_invalidate_in_flight():
+    release = Event()
+    cache = ResponseCache(dict(layers=10))
+    stale = Loader(release)
+
+    threads, results = run_concurrently(1, lambda: cache.get('layers', (), stale))
+    wait_for(lambda: stale.calls == 1)
+    cache.invalidate()
+
+    # A call after invalidation does not wait for the stale request
+    assert cache.get('layers', (), lambda: dict(id='fresh'))['id'] == 'fresh'
+
+    release.set()
+    threads[0].join()
+    assert results[0]['id'] == 1
+    # The stale response did not replace the fresh one
+    assert cache.get('layers', (), Loader())['id'] == 'fresh'
@@ -0,0 +1,81 @@
+import re
+
+import pytest
+
+from rndflow.scanner import DEFAULT_EXCLUDE, ScanRules, glob_regex, scan_files
+from rndflow.errors import JobLimitError
+
+#---------------------------------------------------------------------------
+@pytest.mark.parametrize('pattern, name, matches', [
+    ('*.log',       'a.log',        True),
+    ('*.log',       'dir/a.log',    False),  # '*' does not cross '/'
+    ('a?c',         'abc',          True),
+    ('a?c',         'a/c',          False),
+    ('**/x.txt',    'x.txt',        True),
+    ('**/x.txt',    'a/b/x.txt',    True),
+    ('a/**',        'a/b/c',        True),
+    ('[ab].txt',    'b.txt',        True),
+    ('[!ab].txt',   'b.txt',        False),
+    ('[!ab].txt',   'c.txt',        True),
+    ('a+b.txt',     'a+b.txt',      True),   # Regex metacharacters are literal
+    ('a+b.txt',     'aab.txt',      False),
+])
+def test_glob_regex(pattern, name, matches):
+    assert bool(re.fullmatch(glob_regex(pattern), name)) == matches
+
+#---------------------------------------------------------------------------
+def test_rules():
+    rules = ScanRules(['*.tmp', '/build', 'cache/', 'logs/**/*.txt', '!keep.tmp', '# comment', ''])
+
+    assert rules.excluded('a.tmp', False)
+    assert rules.excluded('dir/a.tmp', False)
+    assert not rules.excluded('keep.tmp', False)      # Re-included: the last matching rule wins
+
+    assert rules.excluded('build', True)
+    assert not rules.excluded('src/build', True)      # Anchored to the root
+
+    assert rules.excluded('out/cache', True)
+    assert not rules.excluded('out/cache', False)     # Directories only
+
+    assert rules.excluded('logs/a/b/c.txt', False)
+    assert not rules.excluded('logs/a/b/c.csv', False)
+
+def test_default_rules():
+    rules = ScanRules(DEFAULT_EXCLUDE)
+
+    # Top-level directories only, as before the scanner existed
+    for name in ('in', '__pycache__', '.ipynb_checkpoints'):
+        assert rules.excluded(name, True)
+        assert not rules.excluded(f'out/{name}', True)
+
+#---------------------------------------------------------------------------
+def make_tree(root, names):
+    for name in names:
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'x' * 10)
+
+def test_scan_files(tmp_path):
+    make_tree(tmp_path, ['a.txt', 'in/1/files/x', 'out/1/label', 'out/1/files/y.h5', 'out/skip/z', 'b.tmp'])
+
+    files = scan_files(tmp_path, ScanRules(DEFAULT_EXCLUDE + ('skip/', '*.tmp')), skip=[tmp_path / 'a.txt'])
+
+    assert sorted(f.name for f in files) == ['out/1/files/y.h5', 'out/1/label']
+    assert all(f.path == tmp_path / f.name and f.stat.st_size == 10 for f in files)
+
+def test_scan_subdir(tmp_path):
+    make_tree(tmp_path, ['a.txt', 'out/1/label'])
+
+    assert [f.name for f in scan_files(tmp_path, subdir='out')] == ['out/1/label']
+    assert not scan_files(tmp_path, subdir='missing')
+
+def test_scan_limits(tmp_path):
+    make_tree(tmp_path, ['a', 'b', 'c'])
+
+    assert len(scan_files(tmp_path, max_files=3, max_bytes=30)) == 3
+
+    with pytest.raises(JobLimitError, match='upload_max_files'):
+        scan_files(tmp_path, max_files=2)
+
+    with pytest.raises(JobLimitError, match='upload_max_bytes'):
+        scan_files(tmp_path, max_bytes=25)
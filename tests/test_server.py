@@ -0,0 +1,126 @@
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Barrier, Lock, Thread
+
+import pytest
+
+import rndflow.server
+from rndflow.server import Server
+
+#---------------------------------------------------------------------------
+class Api(BaseHTTPRequestHandler):
+    """
+    Refresh endpoint issuing token-<n> that lives `lifetime` seconds, and
+    GET endpoints answering 401 to anything but the current token.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+    def reply(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self): # pylint: disable=invalid-name
+        state = self.server.state
+        with state['lock']:
+            state['refreshes'] += 1
+            state['token'] = f"token-{state['refreshes']}"
+            token = state['token']
+        self.reply(200, dict(access_token=token, refresh_token=f'refresh-{token}', expires_in=state['lifetime']))
+
+    def do_GET(self): # pylint: disable=invalid-name
+        state = self.server.state
+        if self.headers.get('Authorization') != f"Bearer {state['token']}":
+            self.reply(401, dict(detail='Unauthorized'))
+        else:
+            self.reply(200, dict(path=self.path))
+
+class ApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+    state = None
+
+    def handle_error(self, request, client_address):
+        pass # Clients dropping keep-alive connections at the end of a test
+
+@pytest.fixture(name='api')
+def api_fixture():
+    httpd = ApiServer(('127.0.0.1', 0), Api)
+    httpd.state = dict(lock=Lock(), refreshes=0, token=None, lifetime=3600)
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+@pytest.fixture(name='clock')
+def clock_fixture(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rndflow.server, 'time', lambda: now[0])
+    return now
+
+def connect(api):
+    return Server(api_server=f'http://127.0.0.1:{api.server_port}')
+
+#---------------------------------------------------------------------------
+def test_short_lived_token_is_not_refreshed_every_request(api, clock):
+    api.state['lifetime'] = 30 # Less than token_refresh_margin
+    server = connect(api)
+
+    for _ in range(5):
+        assert server.get('/items')['path'] == '/api/items'
+        clock[0] += 1
+    assert api.state['refreshes'] == 1
+
+    clock[0] += 15 # Past half of the lifetime
+    server.get('/items')
+    assert api.state['refreshes'] == 2
+
+def test_refresh_before_expiry(api, clock):
+    server = connect(api)
+    margin = server.cfg.token_refresh_margin
+
+    clock[0] += 3600 - margin - 1
+    server.get('/items')
+    assert api.state['refreshes'] == 1
+
+    clock[0] += 2
+    server.get('/items')
+    assert api.state['refreshes'] == 2
+    assert server.access_token == 'token-2'
+
+def test_unauthorized_is_refreshed_once(api):
+    server = connect(api)
+    api.state['token'] = 'revoked' # Every request with token-1 gets 401
+
+    threads = 8
+    barrier = Barrier(threads)
+    results = []
+
+    def call():
+        barrier.wait()
+        results.append(server.get('/items'))
+
+    workers = [Thread(target=call) for _ in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    assert len(results) == threads
+    assert api.state['refreshes'] == 2 # The first one is made by Server()
+
+def test_expiring_refresh_is_rechecked_under_lock(api, clock):
+    server = connect(api)
+
+    # A thread that read the old refresh time together with the new token must not refresh again
+    server.refresh_tokens(stale_token=server.access_token, expiring=True)
+    assert api.state['refreshes'] == 1
+
+    clock[0] += 3600
+    server.refresh_tokens(stale_token=server.access_token, expiring=True)
+    assert api.state['refreshes'] == 2